@@ -0,0 +1,178 @@
+# Link Fixer - end to end benchmark
+#
+# generates a synthetic project, serves it from the mock Jama server and runs link_fixer.py against it in a
+# scratch directory. reports items/sec, links/sec, API calls per item and the peak RSS of the script, and saves
+# the results to a JSON file so runs on different commits can be compared.
+#
+# usage (from the repository root):
+#   python benchmarks/bench_end_to_end.py --items 2000 --latency 0.005
+#   python benchmarks/bench_end_to_end.py --param "scan workers=4" --compare benchmarks/results/<commit>.json
+#
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is not reported there
+    resource = None
+
+import mock_jama_server
+import synthetic_project
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RESULTS_DIR = os.path.join(REPOSITORY_DIR, 'benchmarks', 'results')
+METRICS = ['seconds', 'itemsPerSecond', 'linksPerSecond', 'apiCallsPerItem', 'peakRssMb']
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_config(path, instance_url, parameters):
+    lines = ['[CREDENTIALS]',
+             'instance url = ' + instance_url,
+             'using oauth = False',
+             'username = benchmark',
+             'password = benchmark',
+             'disable ssl = False',
+             '',
+             '[PARAMETERS]',
+             'project id = ' + str(synthetic_project.NEW_PROJECT_ID),
+             'link mode = True',
+             'text mode = True',
+             'display attribute = name']
+    for key, value in parameters.items():
+        lines.append(key + ' = ' + value)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def get_peak_rss_mb():
+    # the largest resident set of any child process that has finished, ru_maxrss is in KB on linux
+    # and in bytes on macOS
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss / 1024
+    return round(peak_rss / 1024, 1)
+
+
+def run_benchmark(args, parameters):
+    server, summary = mock_jama_server.start_server(args.items, port=args.port, latency=args.latency,
+                                                    rate_limit=args.rate_limit,
+                                                    failure_share=args.failure_share,
+                                                    links_per_field=args.links_per_field,
+                                                    fragment_share=args.fragment_share,
+                                                    broken_share=args.broken_share,
+                                                    locked_share=args.locked_share,
+                                                    seed=args.seed, link_share=args.link_share)
+    try:
+        with tempfile.TemporaryDirectory() as run_dir:
+            write_config(os.path.join(run_dir, 'config.ini'), server.base_url, parameters)
+            start_time = time.time()
+            completed = subprocess.run([sys.executable, os.path.join(REPOSITORY_DIR, 'link_fixer.py')],
+                                       cwd=run_dir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE)
+            seconds = time.time() - start_time
+    finally:
+        server.shutdown()
+
+    if completed.returncode != 0:
+        sys.exit('link_fixer.py failed:\n' + completed.stderr.decode('utf-8', 'replace'))
+    # every item with a broken link that is not locked should have been patched exactly once
+    if server.calls['patch'] != summary['itemsToPatch']:
+        sys.exit('expected ' + str(summary['itemsToPatch']) + ' patched item(s), the script patched ' +
+                 str(server.calls['patch']))
+
+    # the requests the mock server refused are counted in apiCalls but not in the calls per item
+    api_calls = sum(count for endpoint, count in server.calls.items() if endpoint not in ('throttled', 'failed',
+                                                                                          'not modified'))
+    return {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'project': summary,
+        'latency': args.latency,
+        'rateLimit': args.rate_limit,
+        'failureShare': args.failure_share,
+        'parameters': parameters,
+        'seconds': round(seconds, 3),
+        'itemsPerSecond': round(summary['items'] / seconds, 1),
+        'linksPerSecond': round(summary['links'] / seconds, 1),
+        'apiCallsPerItem': round(api_calls / summary['items'], 3),
+        'apiCalls': dict(server.calls),
+        'peakRssMb': get_peak_rss_mb()
+    }
+
+
+def print_results(results, baseline=None):
+    print('{:>18} {:>14}'.format('metric', results['commit']) +
+          ('' if baseline is None else ' {:>14} {:>9}'.format(baseline['commit'], 'change')))
+    for metric in METRICS:
+        value = results[metric]
+        line = '{:>18} {:>14}'.format(metric, str(value))
+        if baseline is not None:
+            baseline_value = baseline.get(metric)
+            change = ''
+            if value is not None and baseline_value:
+                change = '%+.1f%%' % ((value - baseline_value) * 100.0 / baseline_value)
+            line += ' {:>14} {:>9}'.format(str(baseline_value), change)
+        print(line)
+    print('{:>18} {}'.format('api calls', json.dumps(results['apiCalls'], sort_keys=True)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs link_fixer.py end to end against a mock Jama server.')
+    parser.add_argument('--items', type=int, default=1000, help='number of items in the synthetic project')
+    parser.add_argument('--links-per-field', type=int, default=3, help='jama links in each description')
+    parser.add_argument('--fragment-share', type=float, default=0.5,
+                        help='share of links using the #/items/..?projectId= format rather than docId=')
+    parser.add_argument('--broken-share', type=float, default=0.5, help='share of links to the deleted project')
+    parser.add_argument('--locked-share', type=float, default=0.1, help='share of items that are locked')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--link-share', type=float, default=1.0,
+                        help='share of items with any jama links, the rest only link to other sites')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the mock server waits before every response')
+    parser.add_argument('--rate-limit', type=float,
+                        help='requests per second the mock server allows before answering with a 429')
+    parser.add_argument('--failure-share', type=float, default=0.0,
+                        help='share of requests the mock server fails with a 503')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port of the mock server, set it to keep the instance url the same between runs')
+    parser.add_argument('--param', action='append', default=[],
+                        help='extra config.ini parameter for the run, e.g. "scan workers=4". can be repeated')
+    parser.add_argument('--output', help='results file, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    run_parameters = {}
+    for param in args.param:
+        key, value = param.split('=', 1)
+        run_parameters[key.strip()] = value.strip()
+
+    benchmark_results = run_benchmark(args, run_parameters)
+    baseline_results = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline_results = json.load(f)
+    print_results(benchmark_results, baseline_results)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, benchmark_results['commit'] + '.json')
+    with open(output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    print('results saved to ' + output)
@@ -0,0 +1,80 @@
+# Link Fixer - locked items report benchmark
+#
+# compares the original report (every row kept until the end of the run, then added to a normal workbook and
+# styled in a second pass) with the current report in each of its formats, on 1,000, 10,000 and 100,000
+# locked items. "adding rows" is the total time spent adding all the rows, as the items are found during the
+# run, "at close" is what is left for the end of the run.
+#
+# usage (from the repository root):
+#   python benchmarks/bench_locked_items_report.py
+#
+import os
+import sys
+import tempfile
+import time
+
+import openpyxl
+from openpyxl.styles import Font
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import link_fixer
+
+ROW_COUNTS = [1000, 10000, 100000]
+INSTANCE_URL = 'https://example.jamacloud.com'
+
+
+def build_rows(row_count):
+    return [('NEW-' + str(i), 'Locking User', INSTANCE_URL + '/perspective.req#/items/' + str(2000000 + i) +
+             '?projectId=2') for i in range(row_count)]
+
+
+def write_original_report(path, rows):
+    # the report as it was written before, returns (seconds adding the rows, seconds at close)
+    start_time = time.time()
+    locked_item_data = {}
+    for item_name, locked_by, url in rows:
+        if item_name not in locked_item_data:
+            locked_item_data[item_name] = [item_name, locked_by, url]
+    rows_seconds = time.time() - start_time
+
+    start_time = time.time()
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet['A1'] = "ID"
+    sheet['B1'] = "Locked By"
+    sheet['C1'] = "URL Link to Item"
+    for item in locked_item_data:
+        sheet.append(locked_item_data[item])
+    hyperlink_font = Font(color="0000FF", underline="single")
+    for row in sheet.iter_rows(min_row=2, min_col=3, max_col=3):
+        cell = row[0]
+        cell.hyperlink = cell.value
+        cell.font = hyperlink_font
+    workbook.save(path)
+    return rows_seconds, time.time() - start_time
+
+
+def write_report(path, rows):
+    start_time = time.time()
+    report = link_fixer.LockedItemsReport(path)
+    for item_name, locked_by, url in rows:
+        report.add(item_name, locked_by, url)
+    rows_seconds = time.time() - start_time
+    start_time = time.time()
+    report.close(create=True)
+    return rows_seconds, time.time() - start_time
+
+
+if __name__ == '__main__':
+    print('{:>8} {:>22} {:>22} {:>22} {:>22}'.format('rows', 'original xlsx (s)', 'xlsx (s)',
+                                                     'csv (s)', 'jsonl (s)'))
+    print('{:>8} {:>22} {:>22} {:>22} {:>22}'.format('', *(['adding rows / at close'] * 4)))
+    with tempfile.TemporaryDirectory() as report_dir:
+        for row_count in ROW_COUNTS:
+            report_rows = build_rows(row_count)
+            timings = [write_original_report(os.path.join(report_dir, 'original.xlsx'), report_rows)]
+            for extension in ['xlsx', 'csv', 'jsonl']:
+                timings.append(write_report(os.path.join(report_dir, 'report.' + extension), report_rows))
+            print('{:>8} '.format(row_count) + ' '.join('{:>22}'.format('%.3f / %.3f' % timing)
+                                                        for timing in timings))
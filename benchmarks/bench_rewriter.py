@@ -0,0 +1,83 @@
+# Link Fixer - field rewriter microbenchmark
+#
+# compares the original rewrite (one str.replace over the whole field per bad link) with the single pass
+# offset based rewrite on fields holding 1, 100 and 1,000 links.
+#
+# usage (from the repository root):
+#   python benchmarks/bench_rewriter.py
+#
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import link_fixer
+
+LINK_COUNTS = [1, 100, 1000]
+INSTANCE_URL = 'https://example.jamacloud.com'
+
+
+def build_field(link_count):
+    # a rich text field with link_count distinct links to a deleted project, separated by some filler text
+    anchors = []
+    for i in range(link_count):
+        anchors.append('<p>Some requirement text that refers to <a href="' + INSTANCE_URL +
+                       '/perspective.req?docId=' + str(1000 + i) + '&amp;projectId=1">OLD-' + str(i) +
+                       '</a> for more detail.</p>')
+    return '\n'.join(anchors)
+
+
+def build_corrections(value):
+    # the corrected anchor for every link, as the scan would work them out
+    corrections = []
+    for anchor in link_fixer.extract_links_tokenizer(value):
+        corrected = anchor.html.replace('projectId=1', 'projectId=2').replace('docId=1', 'docId=2')
+        corrections.append((anchor, corrected))
+    return corrections
+
+
+def rewrite_with_replace(value, corrections):
+    for anchor, corrected in corrections:
+        value = value.replace(anchor.html, corrected)
+    return value
+
+
+def rewrite_with_offsets(value, corrections):
+    edits = [(anchor.start, anchor.end, corrected) for anchor, corrected in corrections]
+    return link_fixer.apply_edits(value, edits)
+
+
+def rewrite_with_located_offsets(value, corrections):
+    # for the extractors that do not report offsets, the anchors are located in the field first
+    anchor_spans = link_fixer.index_anchor_spans(value, [anchor._replace(start=None, end=None)
+                                                         for anchor, corrected in corrections])
+    edits = []
+    for anchor, corrected in corrections:
+        for start, end in anchor_spans[anchor.html]:
+            edits.append((start, end, corrected))
+    return link_fixer.apply_edits(value, edits)
+
+
+def bench(func, value, corrections):
+    timer = timeit.Timer(lambda: func(value, corrections))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+
+if __name__ == '__main__':
+    print('{:>8} {:>18} {:>18} {:>18}'.format('links', 'str.replace (ms)', 'offsets (ms)', 'located (ms)'))
+    for link_count in LINK_COUNTS:
+        field = build_field(link_count)
+        field_corrections = build_corrections(field)
+
+        # all three approaches must produce the same field before we compare their speed
+        expected = rewrite_with_replace(field, field_corrections)
+        assert rewrite_with_offsets(field, field_corrections) == expected
+        assert rewrite_with_located_offsets(field, field_corrections) == expected
+
+        print('{:>8} {:>18.4f} {:>18.4f} {:>18.4f}'.format(
+            link_count,
+            bench(rewrite_with_replace, field, field_corrections) * 1000,
+            bench(rewrite_with_offsets, field, field_corrections) * 1000,
+            bench(rewrite_with_located_offsets, field, field_corrections) * 1000))
@@ -0,0 +1,238 @@
+# Link Fixer - local stand-in for the Jama REST API
+#
+# serves a synthetic project (see synthetic_project.py) on the endpoints link_fixer.py uses, counting every
+# request by endpoint. the old project is gone, so its items can only be reached through the synced items.
+#
+# it can also throttle like a shared Jama Cloud tenant, answering requests over a rate limit with a 429 and a
+# Retry-After header, and fail a share of the requests with a 503. every response to a GET has an ETag, and a
+# request whose If-None-Match still matches is answered with a 304.
+#
+# used by bench_end_to_end.py, or on its own to point link_fixer.py at (instance url = http://127.0.0.1:8080):
+#   python benchmarks/mock_jama_server.py --port 8080 --items 1000
+#
+import argparse
+import collections
+import hashlib
+import html
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse as urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import synthetic_project
+
+API_PREFIX = '/rest/v1/'
+
+
+def get_indexed_text(value):
+    # the text of a field as the search sees it, with the tags stripped
+    return html.unescape(re.sub(r'<[^>]*>', ' ', str(value)))
+
+
+class MockJamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, rate_limit=None, failure_share=0.0):
+        super().__init__(('127.0.0.1', port), MockJamaRequestHandler)
+        self.latency = latency
+        # requests per second allowed before answering with a 429, None for no limit
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit or 0
+        self.tokens_updated = time.monotonic()
+        self.failure_share = failure_share
+        self.items = {}
+        self.project_items = {}
+        self.synced_items = {}
+        self.users = {synthetic_project.LOCK_OWNER['id']: synthetic_project.LOCK_OWNER}
+        self.projects = [{'id': synthetic_project.NEW_PROJECT_ID, 'fields': {'name': 'Duplicated project'}}]
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def load_project(self, items, synced_items):
+        self.items = items
+        self.synced_items = synced_items
+        # every item is in the one project, keep the list so paging through it is cheap
+        self.project_items = collections.defaultdict(list)
+        for item in items.values():
+            self.project_items[item['project']].append(item)
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def take_token(self):
+        # token bucket holding a second worth of requests, returns False once the rate limit is used up
+        if self.rate_limit is None:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.tokens_updated) * self.rate_limit, self.rate_limit)
+            self.tokens_updated = now
+            if self.tokens < 1:
+                self.calls['throttled'] += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockJamaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body):
+        payload = json.dumps(body).encode('utf-8')
+        etag = None
+        if self.command == 'GET' and status_code == 200:
+            etag = '"' + hashlib.sha1(payload).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.server.count('not modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_page(self, data, query):
+        start_at = int(query.get('startAt', ['0'])[0])
+        max_results = int(query.get('maxResults', ['20'])[0])
+        page = data[start_at:start_at + max_results]
+        self.send_json(200, {'meta': {'status': 'OK', 'pageInfo': {'startIndex': start_at,
+                                                                   'resultCount': len(page),
+                                                                   'totalResults': len(data)}},
+                             'data': page})
+
+    def send_not_found(self):
+        self.send_json(404, {'meta': {'status': 'Not Found', 'message': 'Resource not found'}})
+
+    def refuse_request(self):
+        # throttle or fail the request like a busy instance would, returns True if the request was refused
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if not self.server.take_token():
+            payload = json.dumps({'meta': {'status': 'Too Many Requests', 'message': 'Rate limit exceeded'}})
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(payload.encode('utf-8'))
+            return True
+        if self.server.failure_share > 0 and random.random() < self.server.failure_share:
+            self.server.count('failed')
+            self.send_json(503, {'meta': {'status': 'Service Unavailable', 'message': 'Try again later'}})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.refuse_request():
+            return
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        resource = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else None
+
+        if resource == '':
+            self.server.count('endpoints')
+            return self.send_json(200, {'meta': {'status': 'OK'}, 'data': []})
+        if resource == 'projects':
+            self.server.count('projects')
+            return self.send_page(self.server.projects, query)
+        if resource == 'items':
+            self.server.count('items')
+            project_id = int(query.get('project', ['0'])[0])
+            return self.send_page(self.server.project_items.get(project_id, []), query)
+        if resource == 'users':
+            self.server.count('users')
+            return self.send_page(list(self.server.users.values()), query)
+        if resource == 'abstractitems':
+            # the search index holds the text of the fields with the html entities decoded. the markup,
+            # including the urls in href attributes, is not indexed
+            self.server.count('abstractitems')
+            project_ids = [int(project_id) for project_id in query.get('project', [])]
+            search_terms = query.get('contains', [])
+            found = [dict(item, type='items') for item in self.server.items.values()
+                     if (not project_ids or item['project'] in project_ids) and
+                     any(search_term in get_indexed_text(value) for value in item['fields'].values()
+                         for search_term in search_terms)]
+            return self.send_page(found, query)
+
+        match = re.match(r'items/(\d+)/synceditems$', resource or '')
+        if match is not None:
+            self.server.count('synceditems')
+            return self.send_page(self.server.synced_items.get(int(match.group(1)), []), query)
+        match = re.match(r'items/(\d+)$', resource or '')
+        if match is not None:
+            self.server.count('item')
+            item = self.server.items.get(int(match.group(1)))
+            if item is None:
+                return self.send_not_found()
+            return self.send_json(200, {'meta': {'status': 'OK'}, 'data': item})
+        match = re.match(r'users/(\d+)$', resource or '')
+        if match is not None:
+            self.server.count('user')
+            user = self.server.users.get(int(match.group(1)))
+            if user is None:
+                return self.send_not_found()
+            return self.send_json(200, {'meta': {'status': 'OK'}, 'data': user})
+
+        self.send_not_found()
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if self.refuse_request():
+            return
+        self.server.count('patch')
+        match = re.match(API_PREFIX + r'items/(\d+)$', self.path)
+        item = self.server.items.get(int(match.group(1))) if match is not None else None
+        if item is None:
+            return self.send_not_found()
+        if item['lock']['locked']:
+            return self.send_json(400, {'meta': {'status': 'Bad Request', 'message': 'item is locked'}})
+        with self.server.lock:
+            for operation in body:
+                item['fields'][operation['path'].split('/')[-1]] = operation['value']
+        self.send_json(200, {'meta': {'status': 'OK'}})
+
+
+def start_server(item_count, port=0, latency=0.0, rate_limit=None, failure_share=0.0, **generator_args):
+    # start a mock server in a background thread, serving a freshly generated project.
+    # returns the server and the summary of the generated project
+    server = MockJamaServer(port, latency, rate_limit, failure_share)
+    items, synced_items, summary = synthetic_project.generate_project(server.base_url, item_count, **generator_args)
+    server.load_project(items, synced_items)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves a synthetic Jama project over HTTP.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every response')
+    parser.add_argument('--rate-limit', type=float, help='requests per second before answering with a 429')
+    parser.add_argument('--failure-share', type=float, default=0.0, help='share of requests that fail with a 503')
+    args = parser.parse_args()
+    mock_server, project_summary = start_server(args.items, args.port, args.latency, args.rate_limit,
+                                                args.failure_share)
+    print('serving ' + json.dumps(project_summary) + ' on ' + mock_server.base_url + ' (project id ' +
+          str(synthetic_project.NEW_PROJECT_ID) + '), press ctrl+c to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock_server.shutdown()
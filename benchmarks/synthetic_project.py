@@ -0,0 +1,122 @@
+# Link Fixer - synthetic Jama project generator
+#
+# builds the data for a project that was duplicated from a project that has since been deleted. every item in
+# the new project has a synced copy of itself in the old project, and its description holds a mix of links to
+# the old project (broken), links to the new project (valid) and links to other sites. a share of the items
+# can be left without any jama links, like most items in a real project.
+#
+# used by the mock Jama server in bench_end_to_end.py, or on its own to look at the data:
+#   python benchmarks/synthetic_project.py --items 5
+#
+import argparse
+import json
+import random
+
+OLD_PROJECT_ID = 1
+NEW_PROJECT_ID = 2
+OLD_ITEM_ID_BASE = 1000000
+NEW_ITEM_ID_BASE = 2000000
+LOCK_OWNER = {'id': 7, 'firstName': 'Locking', 'lastName': 'User', 'username': 'locking.user'}
+
+
+def build_link(base_url, item_id, project_id, text, fragment_style):
+    # the two url formats jama uses for links to an item
+    if fragment_style:
+        href = base_url + '/perspective.req#/items/' + str(item_id) + '?projectId=' + str(project_id)
+    else:
+        href = base_url + '/perspective.req?docId=' + str(item_id) + '&amp;projectId=' + str(project_id)
+    return '<a href="' + href + '">' + text + '</a>'
+
+
+def generate_project(base_url, item_count, links_per_field=3, fragment_share=0.5, broken_share=0.5,
+                     locked_share=0.1, seed=1, link_share=1.0):
+    # returns the items of the new project keyed by id, the synced items of every old and new item id and
+    # a summary of what was generated. the same arguments always produce the same project
+    rng = random.Random(seed)
+    items = {}
+    synced_items = {}
+    link_count = 0
+    broken_link_count = 0
+    items_to_patch = 0
+    locked_items_with_broken_links = 0
+
+    for i in range(item_count):
+        old_item_id = OLD_ITEM_ID_BASE + i
+        new_item_id = NEW_ITEM_ID_BASE + i
+        synced_items[old_item_id] = [{'id': old_item_id, 'project': OLD_PROJECT_ID},
+                                     {'id': new_item_id, 'project': NEW_PROJECT_ID}]
+        synced_items[new_item_id] = synced_items[old_item_id]
+
+    for i in range(item_count):
+        new_item_id = NEW_ITEM_ID_BASE + i
+        locked = rng.random() < locked_share
+        paragraphs = []
+        item_broken_links = 0
+        # only draw from the generator when some items go without links, so the default project stays the same
+        item_links = links_per_field
+        if link_share < 1 and rng.random() >= link_share:
+            item_links = 0
+        for j in range(item_links):
+            target = rng.randrange(item_count)
+            fragment_style = rng.random() < fragment_share
+            if rng.random() < broken_share:
+                link = build_link(base_url, OLD_ITEM_ID_BASE + target, OLD_PROJECT_ID, 'OLD-' + str(target),
+                                  fragment_style)
+                item_broken_links += 1
+            else:
+                # the link text already matches the target's name, so text mode leaves these alone
+                link = build_link(base_url, NEW_ITEM_ID_BASE + target, NEW_PROJECT_ID, 'Item ' + str(target),
+                                  fragment_style)
+            paragraphs.append('<p>Requirement text that refers to ' + link + ' for more detail.</p>')
+            link_count += 1
+        # a link to another site in every field, the scan has to skip over these
+        paragraphs.append('<p>See also <a href="https://example.com/spec">the spec</a>.</p>')
+
+        broken_link_count += item_broken_links
+        if item_broken_links > 0:
+            if locked:
+                locked_items_with_broken_links += 1
+            else:
+                items_to_patch += 1
+
+        items[new_item_id] = {
+            'id': new_item_id,
+            'documentKey': 'NEW-' + str(i),
+            'globalId': 'GID-' + str(i),
+            'project': NEW_PROJECT_ID,
+            'itemType': 33,
+            'modifiedDate': '2021-06-01T00:00:00.000+0000',
+            'fields': {
+                'name': 'Item ' + str(i),
+                'documentKey': 'NEW-' + str(i),
+                'globalId': 'GID-' + str(i),
+                'description': '\n'.join(paragraphs),
+                'priority': 5
+            },
+            'lock': {'locked': locked, 'lockedBy': LOCK_OWNER['id'] if locked else None}
+        }
+
+    summary = {
+        'items': item_count,
+        'links': link_count,
+        'brokenLinks': broken_link_count,
+        'itemsToPatch': items_to_patch,
+        'lockedItemsWithBrokenLinks': locked_items_with_broken_links
+    }
+    return items, synced_items, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints a synthetic Jama project.')
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--links-per-field', type=int, default=3)
+    parser.add_argument('--fragment-share', type=float, default=0.5)
+    parser.add_argument('--broken-share', type=float, default=0.5)
+    parser.add_argument('--locked-share', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--link-share', type=float, default=1.0)
+    args = parser.parse_args()
+    project_items, project_synced_items, project_summary = generate_project(
+        'http://127.0.0.1:8080', args.items, args.links_per_field, args.fragment_share, args.broken_share,
+        args.locked_share, args.seed, args.link_share)
+    print(json.dumps({'summary': project_summary, 'items': list(project_items.values())}, indent=2))
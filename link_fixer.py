@@ -1,13 +1,34 @@
+import argparse
+import atexit
+import collections
 import configparser
+import cProfile
+import csv
 import datetime
+import email.utils
 import getpass
+import hashlib
+import html
+import itertools
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import pstats
+import queue
+import random
+import re
+import sqlite3
 import sys
+import threading
 import time
 import warnings
 import urllib.parse as urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import openpyxl
+import requests
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.hyperlink import Hyperlink
@@ -16,9 +37,836 @@ from bs4 import BeautifulSoup
 from halo import Halo
 from progress.bar import ChargingBar
 
-from py_jama_rest_client.client import JamaClient, APIException
+from py_jama_rest_client.client import JamaClient, APIException, APIServerException, TooManyRequestsException
+from py_jama_rest_client.core import CoreException
+
+# per project counters for the run summary, keyed by project id
+project_stats = collections.defaultdict(collections.Counter)
+# per project scan outcome of every item that was not clean, keyed by project id then item id.
+# one of 'fixed', 'locked' or 'unresolved', items missing from here were clean
+project_outcomes = collections.defaultdict(dict)
+# html parsing stats for the whole run, keyed by field name
+field_stats = collections.defaultdict(collections.Counter)
+# in a scan worker process, the items of each shard it parsed and the links found on them, keyed by shard id.
+# they stay here between the parse and the rewrite so the items are only sent to the worker once
+parsed_shards = {}
+# ids for the shards handed to the scan workers, unique for the whole run
+shard_ids = itertools.count()
+
+# the requests that are safe to send again after a server error (5xx) or a dropped connection. the patches this
+# script sends replace whole field values, so a patch that is sent twice leaves the item the same
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PATCH')
+
+# the default item cache size in streaming mode, so memory use does not grow with the size of the project
+STREAMING_ITEM_CACHE_SIZE = 10000
+
+# an anchor found in a rich text field. html is the anchor markup the rewrite works from, start and end are
+# its offsets in the original field value when the extractor can report them, otherwise None
+Anchor = collections.namedtuple('Anchor', ['href', 'html', 'start', 'end'])
+# what a jama link should point at, worked out by build_link_target_index before the scan. display_value is
+# the corrected item's display attribute, only looked up in text mode. either can be None if unresolved
+LinkTarget = collections.namedtuple('LinkTarget', ['corrected_item_id', 'display_value'])
+# one link rewrite in a field. start and end are the anchor's offsets in the field value as it was scanned,
+# old_target and new_target the (project id, item id) the link pointed at before and after the rewrite
+LinkEdit = collections.namedtuple('LinkEdit', ['start', 'end', 'replacement', 'old_target', 'new_target'])
+
+anchor_pattern = re.compile(r'<a(?=[\s>])[^>]*>.*?</a\s*>', re.IGNORECASE | re.DOTALL)
+end_tag_pattern = re.compile(r'</a\s*>', re.IGNORECASE)
+href_pattern = re.compile(r'\shref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.IGNORECASE)
+
+# the read only endpoints the response cache keeps, and how many seconds a response from each is used before it
+# is revalidated. items are always revalidated, a lock or an edit since the last run has to be seen
+RESPONSE_CACHE_ENDPOINTS = [('projects', r'/rest/v1/projects/?$'),
+                            ('users', r'/rest/v1/users(/\d+)?/?$'),
+                            ('synceditems', r'/rest/v1/items/\d+/synceditems/?$'),
+                            ('items', r'/rest/v1/items/\d+/?$')]
+RESPONSE_CACHE_TTLS = {'projects': 3600, 'users': 86400, 'synceditems': 3600, 'items': 0}
+
+LOCKED_ITEMS_HEADERS = ["ID", "Locked By", "URL Link to Item"]
+
+# log levels below INFO for the detail of each item and of each link, so the run summary is all that is logged
+# at INFO. they sit above DEBUG so the debug logging of requests and urllib3 stays out of the link detail
+ITEM_DETAIL = 15
+LINK_DETAIL = 12
+logging.addLevelName(ITEM_DETAIL, 'ITEM')
+logging.addLevelName(LINK_DETAIL, 'LINK')
+LOG_VERBOSITY_LEVELS = {'run': logging.INFO, 'item': ITEM_DETAIL, 'link': LINK_DETAIL}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # one JSON object per log record. structured data passed as extra={'data': {...}} is kept as it is
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        if record.processName != 'MainProcess':
+            entry['process'] = record.processName
+        if getattr(record, 'data', None) is not None:
+            entry['data'] = record.data
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # hands records to the log listener thread as they are, so the message is only formatted on that thread.
+    # records from the scan workers cross a process boundary and go through the plain QueueHandler instead
+    def prepare(self, record):
+        return record
+
+
+class ItemCache:
+    # in-process store of one field of each item (the display attribute link text is rewritten to), keyed by
+    # item id. only that field is kept, not the whole item, so the cache stays small however many items pass
+    # through it. seeded from the items as they are retrieved and filled lazily from the api on a miss. a
+    # max_size of zero means unbounded, otherwise the least recently used items are evicted past the limit.
+    def __init__(self, jama_client, field_key, max_size=0):
+        self.client = jama_client
+        self.field_key = field_key
+        self.max_size = max_size
+        self.values = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # projects can be processed on several threads at once in batch mode
+        self.lock = threading.Lock()
+
+    def seed(self, item_list):
+        for item in item_list:
+            self.put(item)
+
+    def put(self, item):
+        item_id = int(item.get('id'))
+        # None if the item has no such field
+        value = item.get('fields', {}).get(self.field_key)
+        with self.lock:
+            self.values[item_id] = (item.get('project'), value)
+            self.values.move_to_end(item_id)
+            if 0 < self.max_size < len(self.values):
+                self.values.popitem(last=False)
+
+    def get(self, item_id):
+        item_id = int(item_id)
+        with self.lock:
+            if item_id in self.values:
+                self.hits += 1
+                self.values.move_to_end(item_id)
+                return self.values[item_id][1]
+            self.misses += 1
+
+        # cache miss, go to the api. let any APIException bubble up to the caller
+        item = call_api(self.client.get_item, item_id)
+        self.put(item)
+        return item.get('fields', {}).get(self.field_key)
+
+    def release_project(self, project_id):
+        # links are only ever corrected to items in the project being fixed, so once a project is done its
+        # items are of no use to the other projects in the run
+        with self.lock:
+            for item_id in [item_id for item_id, (item_project_id, value) in self.values.items()
+                            if item_project_id == project_id]:
+                del self.values[item_id]
+
+
+class CircuitOpenError(Exception):
+    # raised for every api request once too many recent requests have failed, this stops the run
+    pass
+
+
+class RequestScheduler:
+    # every HTTP request to jama waits here first. a token bucket paces the requests to at most `rate` a second,
+    # a 429 pauses every caller for its Retry-After time and halves the rate, and the rate creeps back up with
+    # every request that goes through. once too many of the recent requests have failed the circuit opens, and
+    # every request after that raises CircuitOpenError
+    window_size = 50
+    min_window_size = 20
+    min_rate = 0.5
+    rate_increase = 0.1
+
+    def __init__(self, max_rate=None, max_error_rate=0.5):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_slow_down = 0.0
+        # when the requests we sent went out, to work out the rate to slow down from when there is no limit
+        self.recent_requests = collections.deque(maxlen=100)
+        # None for each recent request that went through, otherwise what went wrong
+        self.outcomes = collections.deque(maxlen=self.window_size)
+        self.max_error_rate = max_error_rate
+        self.throttled_responses = 0
+        self.retried_requests = 0
+        self.open_reason = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # blocks until the next request may go out
+        while True:
+            with self.lock:
+                if self.open_reason is not None:
+                    raise CircuitOpenError(self.open_reason)
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        self.recent_requests.append(now)
+                        return
+                    # the bucket holds at most a second worth of requests
+                    self.tokens = min(self.tokens + (now - self.updated) * self.rate, max(self.rate, 1.0))
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.recent_requests.append(now)
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after):
+        # a 429, back off every caller rather than just the one that was throttled
+        with self.lock:
+            self.throttled_responses += 1
+            now = time.monotonic()
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            # the requests in flight are usually throttled together, only slow down once for all of them
+            if now - self.last_slow_down < 1:
+                return
+            self.last_slow_down = now
+            current_rate = self.rate
+            if len(self.recent_requests) > 1 and now > self.recent_requests[0]:
+                recent_rate = len(self.recent_requests) / (now - self.recent_requests[0])
+                current_rate = recent_rate if current_rate is None else min(current_rate, recent_rate)
+            if current_rate is None:
+                current_rate = 1.0
+            self.rate = max(current_rate / 2, self.min_rate)
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = now
+        logger.warning('API requests are being throttled, slowing down to ' + '%.1f' % self.rate +
+                       ' request(s) per second')
+
+    def record(self, failure):
+        # failure is None for a request that went through, otherwise a short description of what went wrong
+        with self.lock:
+            self.outcomes.append(failure)
+            if failure is None:
+                if self.rate is not None and (self.max_rate is None or self.rate < self.max_rate):
+                    self.rate = self.rate + self.rate_increase
+                    if self.max_rate is not None:
+                        self.rate = min(self.rate, self.max_rate)
+                return
+            failures = [outcome for outcome in self.outcomes if outcome is not None]
+            if (self.open_reason is not None or len(self.outcomes) < self.min_window_size or
+                    len(failures) <= self.max_error_rate * len(self.outcomes)):
+                return
+            failure_counts = collections.Counter(failures)
+            self.open_reason = (str(len(failures)) + ' of the last ' + str(len(self.outcomes)) +
+                                ' API requests failed (' + ', '.join(reason + ': ' + str(count) for reason, count
+                                                                     in sorted(failure_counts.items())) + ')')
+        logger.error('Stopping the run, ' + self.open_reason)
+
+    def to_dict(self):
+        with self.lock:
+            return {'maxRate': self.max_rate,
+                    'finalRate': round(self.rate, 1) if self.rate is not None else None,
+                    'throttledResponses': self.throttled_responses,
+                    'retriedRequests': self.retried_requests,
+                    'stoppedEarly': self.open_reason}
+
+
+class ResponseCache:
+    # sqlite store of the responses to read only api requests, kept between runs and keyed by the request url
+    # (which includes the instance). a response is used as is until the ttl of its endpoint runs out, after
+    # that it is revalidated with its ETag or Last-Modified header where the server sent one. the least
+    # recently used responses are dropped once the store is over its size limit
+    def __init__(self, path, max_bytes, ttls):
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # a write lost in a crash only costs one more request next time
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                'url TEXT PRIMARY KEY, item_id INTEGER, headers TEXT, body BLOB, '
+                                'stored_at REAL, used_at REAL, size INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_item_id ON responses (item_id)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_ttl(self, url):
+        # seconds a response from this endpoint is used without asking the server, None if it is never cached.
+        # the item lists are what we scan, they are always downloaded
+        endpoint = get_cache_endpoint(url)
+        return self.ttls.get(endpoint) if endpoint is not None else None
+
+    def lookup(self, url):
+        # (headers, body, fresh) of the stored response, or None if there is none
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT headers, body, stored_at FROM responses WHERE url = ?',
+                                          (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            headers, body, stored_at = json.loads(row[0]), row[1], row[2]
+            fresh = time.time() - stored_at < ttl
+            if fresh:
+                self.hits += 1
+                self.connection.execute('UPDATE responses SET used_at = ? WHERE url = ?', (time.time(), url))
+                self.connection.commit()
+            return headers, body, fresh
+
+    def store(self, url, response, stale=False):
+        # stale is True when this replaces a stored response the server no longer confirmed
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            return
+        # only the headers needed to read the body back and to revalidate it
+        headers = {name: response.headers[name] for name in ('Content-Type', 'ETag', 'Last-Modified')
+                   if name in response.headers}
+        # a response that is never fresh and can't be revalidated would never be used, so it is not stored
+        reusable = ttl > 0 or 'ETag' in headers or 'Last-Modified' in headers
+        body = response.content
+        now = time.time()
+        with self.lock:
+            if stale:
+                self.misses += 1
+            row = self.connection.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            if not reusable:
+                if row is not None:
+                    self.connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+                    self.connection.commit()
+                return
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (url, get_cache_item_id(url), json.dumps(headers), body, now, now, len(body)))
+            self.total_bytes += len(body)
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # drop the least recently used responses until the store fits, the caller holds the lock
+        while self.total_bytes > self.max_bytes:
+            row = self.connection.execute('SELECT url, size FROM responses ORDER BY used_at LIMIT 1').fetchone()
+            if row is None:
+                self.total_bytes = 0
+                return
+            self.connection.execute('DELETE FROM responses WHERE url = ?', (row[0],))
+            self.total_bytes -= row[1]
+            self.evictions += 1
+
+    def refresh(self, url):
+        # the server confirmed the stored response is still current (304), start its ttl again
+        with self.lock:
+            self.revalidated += 1
+            now = time.time()
+            self.connection.execute('UPDATE responses SET stored_at = ?, used_at = ? WHERE url = ?', (now, now, url))
+            self.connection.commit()
+
+    def invalidate(self, url):
+        # a change to an item drops every stored response about it, the item and its synced items
+        item_id = get_cache_item_id(url)
+        if item_id is None:
+            return
+        with self.lock:
+            row = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses WHERE item_id = ?',
+                                          (item_id,)).fetchone()
+            self.connection.execute('DELETE FROM responses WHERE item_id = ?', (item_id,))
+            self.total_bytes -= row[0]
+            self.connection.commit()
+
+    def to_dict(self):
+        with self.lock:
+            requests_seen = self.hits + self.revalidated + self.misses
+            return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitRate': round((self.hits + self.revalidated) / requests_seen, 3) if requests_seen else None,
+                    'storedBytes': self.total_bytes}
+
+    def close(self):
+        self.connection.close()
+
+
+def get_cache_endpoint(url):
+    # which of the cached endpoints a request url is for, None if it is not cached
+    path = urlparse.urlparse(url).path
+    for endpoint, pattern in RESPONSE_CACHE_ENDPOINTS:
+        if re.search(pattern, path) is not None:
+            return endpoint
+    return None
+
+
+def get_cache_item_id(url):
+    # the item a request url is about, so changing the item can drop what is stored for it
+    match = re.search(r'/rest/v1/items/(\d+)(/|$)', urlparse.urlparse(url).path)
+    return int(match.group(1)) if match is not None else None
+
+
+def build_cached_response(request, headers, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response._content = body
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class ScheduledHTTPAdapter(requests.adapters.HTTPAdapter):
+    # sends every request on the session through the request scheduler, answering read only requests from
+    # the response cache when it can
+    def __init__(self, scheduler, response_cache=None, **kwargs):
+        self.scheduler = scheduler
+        self.response_cache = response_cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        cached = None
+        if self.response_cache is not None and request.method == 'GET':
+            cached = self.response_cache.lookup(request.url)
+            if cached is not None:
+                headers, body, fresh = cached
+                if fresh:
+                    return build_cached_response(request, headers, body)
+                # ask the server whether the stored response is still current
+                if 'ETag' in headers:
+                    request.headers['If-None-Match'] = headers['ETag']
+                if 'Last-Modified' in headers:
+                    request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        response = self.send_scheduled(request, **kwargs)
+
+        if self.response_cache is not None:
+            if request.method != 'GET':
+                self.response_cache.invalidate(request.url)
+            elif response.status_code == 304 and cached is not None:
+                self.response_cache.refresh(request.url)
+                return build_cached_response(request, cached[0], cached[1])
+            elif response.status_code == 200:
+                self.response_cache.store(request.url, response, stale=cached is not None)
+        return response
+
+    def send_scheduled(self, request, **kwargs):
+        # each request is retried on its own, so a failure part way through a method that pages through many
+        # requests (such as get_items) only repeats that one page. a throttled request (429) was not processed
+        # and is always retried, a server error or a dropped connection only for the RETRY_METHODS
+        max_retries = get_max_retries()
+        for attempt in range(max_retries + 1):
+            self.scheduler.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.scheduler.record('connection error')
+                if attempt == max_retries or request.method not in RETRY_METHODS:
+                    raise
+                failure = type(e).__name__
+            except requests.exceptions.RequestException:
+                self.scheduler.record('connection error')
+                raise
+            else:
+                if response.status_code == 429:
+                    self.scheduler.throttled(parse_retry_after(response.headers.get('Retry-After')))
+                if response.status_code == 429 or response.status_code >= 500:
+                    self.scheduler.record('HTTP ' + str(response.status_code))
+                else:
+                    self.scheduler.record(None)
+                retry = response.status_code == 429 or (response.status_code >= 500 and
+                                                        request.method in RETRY_METHODS)
+                if not retry or attempt == max_retries:
+                    return response
+                failure = 'HTTP ' + str(response.status_code)
+                response.close()
+            with self.scheduler.lock:
+                self.scheduler.retried_requests += 1
+            # half the exponential backoff plus a random share of the other half, so the requests that failed
+            # together do not all retry at the same moment. a Retry-After pause is added by the scheduler
+            delay = 2 ** attempt / 2.0 + random.uniform(0, 2 ** attempt / 2.0)
+            logger.warning(request.method + ' ' + request.path_url + ' failed with ' + failure + ', retrying in ' +
+                           '%.1f' % delay + ' second(s)...')
+            time.sleep(delay)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an http date, returns the number of seconds to wait
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiCallStats:
+    # call counts and latency histograms for every JamaClient method called through call_api. the retries of
+    # the requests a call makes are counted by the request scheduler, their time is part of the call's latency
+    latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def record(self, method_name, seconds, failed):
+        with self.lock:
+            if method_name not in self.methods:
+                self.methods[method_name] = {'calls': 0, 'errors': 0, 'seconds': 0.0, 'maxSeconds': 0.0,
+                                             'histogram': [0] * (len(self.latency_buckets) + 1)}
+            method_stats = self.methods[method_name]
+            method_stats['calls'] += 1
+            method_stats['errors'] += 1 if failed else 0
+            method_stats['seconds'] += seconds
+            method_stats['maxSeconds'] = max(method_stats['maxSeconds'], seconds)
+            bucket = 0
+            while bucket < len(self.latency_buckets) and seconds > self.latency_buckets[bucket]:
+                bucket += 1
+            method_stats['histogram'][bucket] += 1
+
+    def to_dict(self):
+        bucket_labels = ['<=' + str(int(bucket * 1000)) + 'ms' for bucket in self.latency_buckets]
+        bucket_labels.append('>' + str(int(self.latency_buckets[-1] * 1000)) + 'ms')
+        with self.lock:
+            return {method_name: {'calls': method_stats['calls'],
+                                  'errors': method_stats['errors'],
+                                  'seconds': round(method_stats['seconds'], 3),
+                                  'averageMs': round(method_stats['seconds'] * 1000 / method_stats['calls'], 1),
+                                  'maxMs': round(method_stats['maxSeconds'] * 1000, 1),
+                                  'histogram': dict(zip(bucket_labels, method_stats['histogram']))}
+                    for method_name, method_stats in sorted(self.methods.items())}
+
+
+class UserDirectory:
+    # caches lock owner names by user id. names are resolved lazily on first use, can be seeded in
+    # bulk from the users endpoint, and can be persisted to a local file keyed by instance url.
+    def __init__(self, jama_client, instance, cache_file=None):
+        self.client = jama_client
+        self.instance = instance
+        self.cache_file = cache_file
+        self.names = {}
+        # users that could not be looked up (deleted or deactivated), only tried once per run
+        self.failed_user_ids = set()
+
+    def load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.names.update(json.load(f).get(self.instance, {}))
+        except (OSError, ValueError) as e:
+            logger.warning('Unable to read user cache file <' + self.cache_file + '>: ' + str(e))
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        # keep the names cached for any other instances in this file
+        cached_instances = {}
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached_instances = json.load(f)
+        except (OSError, ValueError):
+            pass
+        cached_instances[self.instance] = self.names
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(cached_instances, f, indent=2)
+        except OSError as e:
+            logger.warning('Unable to write user cache file <' + self.cache_file + '>: ' + str(e))
+
+    def seed(self):
+        for user in call_api(self.client.get_users):
+            self.names[str(user.get('id'))] = str(user.get('firstName')) + ' ' + str(user.get('lastName'))
+
+    def get_full_name(self, user_id):
+        if user_id is None:
+            return 'System'
+        if str(user_id) in self.failed_user_ids:
+            return str(user_id)
+        if str(user_id) not in self.names:
+            try:
+                user = call_api(self.client.get_user, user_id)
+            except (APIException, requests.exceptions.RequestException) as e:
+                # the report still needs a row for the item, the user id is better than nothing
+                logger.warning('Unable to look up the name of user ID:[' + str(user_id) + '], reporting the id '
+                               'instead. Exception: ' + str(e))
+                self.failed_user_ids.add(str(user_id))
+                return str(user_id)
+            self.names[str(user_id)] = str(user.get('firstName')) + ' ' + str(user.get('lastName'))
+        return self.names[str(user_id)]
+
+
+class ScanCheckpoint:
+    # sqlite store of how each item looked the last time it was scanned and what the outcome was, keyed
+    # by instance, project and item id. incremental runs use it to skip items that have not changed
+    def __init__(self, path, instance):
+        self.instance = instance
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scan_state ('
+                                'instance TEXT, project_id INTEGER, item_id INTEGER, modified_date TEXT, '
+                                'fields_hash TEXT, outcome TEXT, PRIMARY KEY (instance, project_id, item_id))')
+        self.connection.commit()
+
+    def load(self, project_id):
+        # item id -> (modified date, fields hash, outcome) for every item we have scanned in this project
+        with self.lock:
+            rows = self.connection.execute('SELECT item_id, modified_date, fields_hash, outcome FROM scan_state '
+                                           'WHERE instance = ? AND project_id = ?', (self.instance, project_id))
+            return {row[0]: row[1:] for row in rows}
+
+    def record(self, project_id, rows):
+        # rows of (item id, modified date, fields hash, outcome)
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO scan_state VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(self.instance, project_id) + tuple(row) for row in rows])
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class ItemFix:
+    # what patching an item and logging it as locked needs to know about the item, shared by its field fixes
+    __slots__ = ('item_id', 'project_id', 'document_key', 'locked_by')
+
+    def __init__(self, item_id, project_id, document_key, locked_by):
+        self.item_id = item_id
+        self.project_id = project_id
+        self.document_key = document_key
+        self.locked_by = locked_by
+
+
+class FieldFix:
+    # one field of an item to fix. only the link edits are kept, the new value is built from them and the
+    # scanned value when the patch is sent, so the planned fixes hold no second copy of the field
+    __slots__ = ('item', 'field_name', 'old_value', 'edits', 'link_count')
+
+    def __init__(self, item, field_name, old_value, edits, link_count):
+        self.item = item
+        self.field_name = field_name
+        self.old_value = old_value
+        self.edits = edits
+        self.link_count = link_count
+
+    def build_new_value(self):
+        return apply_edits(self.old_value, [(edit.start, edit.end, edit.replacement) for edit in self.edits])
+
+
+def field_fixes_to_json(field_fixes):
+    # the fix journal record of an item's field fixes, every fix of an item shares its item details
+    item = field_fixes[0].item
+    return {'itemId': item.item_id, 'documentKey': item.document_key, 'lockedBy': item.locked_by,
+            'fields': [{'fieldName': fix.field_name, 'oldValue': fix.old_value, 'linkCount': fix.link_count,
+                        'edits': [list(edit) for edit in fix.edits]} for fix in field_fixes]}
+
+
+def field_fixes_from_json(project_id, record):
+    item = ItemFix(record['itemId'], project_id, record['documentKey'], record['lockedBy'])
+    return [FieldFix(item, field['fieldName'], field['oldValue'],
+                     [LinkEdit(start, end, replacement, tuple(old_target), tuple(new_target))
+                      for start, end, replacement, old_target, new_target in field['edits']],
+                     field['linkCount']) for field in record['fields']]
+
+
+class FixJournal:
+    # append-only JSON Lines journal of the patches planned in STEP TWO and the outcome of every patch_item
+    # call as it completes, so an interrupted run can be picked up with --resume without scanning again
+    def __init__(self, path, resume=False):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        # an interrupted run can leave half a line at the end, start the new records on a line of their own
+        if resume and self.file.tell() > 0:
+            self.file.write('\n')
+
+    def plan(self, project_id, broken_link_map):
+        with self.lock:
+            for item_id, broken_links in broken_link_map.items():
+                record = field_fixes_to_json(broken_links)
+                record.update({'type': 'plan', 'projectId': project_id})
+                self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def done(self, project_id, item_id, outcome):
+        with self.lock:
+            self.file.write(json.dumps({'type': 'done', 'projectId': project_id, 'itemId': item_id,
+                                        'outcome': outcome}) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_fix_journal(path):
+    # project id -> {item id -> broken links} for every planned patch that did not go through. failed patches
+    # are tried again, patched and locked items are done
+    pending = collections.OrderedDict()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line is cut short if the run died while writing it
+                continue
+            if record.get('type') == 'plan':
+                pending.setdefault(record['projectId'], {})[record['itemId']] = field_fixes_from_json(
+                    record['projectId'], record)
+            elif record.get('type') == 'done' and record.get('outcome') != 'failed':
+                pending.get(record['projectId'], {}).pop(record['itemId'], None)
+    return pending
+
+
+class FixPlanWriter:
+    # JSON Lines change plan written by a dry run, one record per field to fix. each record holds the
+    # edits to make against the field value as it was scanned, so --apply can check nothing changed since
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, project_id, broken_link_map):
+        with self.lock:
+            for item_id, broken_links in broken_link_map.items():
+                for b in broken_links:
+                    changes = [{'start': edit.start, 'end': edit.end, 'oldTarget': list(edit.old_target),
+                                'newTarget': list(edit.new_target), 'old': b.old_value[edit.start:edit.end],
+                                'new': edit.replacement} for edit in b.edits]
+                    self.file.write(json.dumps({'projectId': project_id, 'itemId': item_id,
+                                                'documentKey': b.item.document_key, 'field': b.field_name,
+                                                'linkCount': b.link_count,
+                                                'oldValueHash': hash_field_value(b.old_value),
+                                                'changes': changes}) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_fix_plan(path):
+    # project id -> {item id -> [planned field changes]}, in the order they were planned
+    planned_fields = collections.OrderedDict()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            planned_fields.setdefault(record['projectId'], collections.OrderedDict()).setdefault(
+                record['itemId'], []).append(record)
+    return planned_fields
+
+
+class LockedItemsReport:
+    # the locked items that have broken links, written out as they are found rather than kept until the end of
+    # the run. the format follows the file extension: an xlsx workbook (in openpyxl's write only mode, which
+    # keeps the rows in a temporary file until the workbook is saved at close), csv or jsonl. the csv and jsonl
+    # rows are flushed as they are written, so they survive a crash. nothing is written until the first row, so
+    # a run that stops before finding any locked items leaves the last report alone
+    def __init__(self, path):
+        self.path = path
+        self.format = get_report_format(path)
+        self.lock = threading.Lock()
+        # each item is only reported once
+        self.item_names = set()
+        self.workbook = None
+        self.file = None
+        self.closed = False
+
+    def open_report(self):
+        # the caller holds the lock
+        if self.format == 'xlsx':
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet()
+            self.sheet.append(LOCKED_ITEMS_HEADERS)
+            self.hyperlink_font = Font(color="0000FF", underline="single")
+        else:
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+            if self.format == 'csv':
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(LOCKED_ITEMS_HEADERS)
+                self.file.flush()
+
+    def is_open(self):
+        return self.workbook is not None or self.file is not None
+
+    def add(self, item_name, locked_by, url):
+        # returns False if the item is already in the report
+        with self.lock:
+            if item_name in self.item_names:
+                return False
+            self.item_names.add(item_name)
+            if not self.is_open():
+                self.open_report()
+            if self.format == 'xlsx':
+                url_cell = WriteOnlyCell(self.sheet, value=url)
+                url_cell.hyperlink = url
+                url_cell.font = self.hyperlink_font
+                self.sheet.append([item_name, locked_by, url_cell])
+            elif self.format == 'csv':
+                self.writer.writerow([item_name, locked_by, url])
+                self.file.flush()
+            else:
+                self.file.write(json.dumps({'id': item_name, 'lockedBy': locked_by, 'url': url}) + '\n')
+                self.file.flush()
+            return True
+
+    def close(self, create=False):
+        # safe to call more than once, it is also called on the way out if the run dies. create writes a
+        # report with just the headers if no locked items were found, which only the end of a run asks for
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if not self.is_open():
+                if not create:
+                    return
+                self.open_report()
+            if self.format == 'xlsx':
+                self.workbook.save(self.path)
+            else:
+                self.file.close()
+
+
+def get_report_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.json'):
+        return 'jsonl'
+    return 'xlsx'
+
+
+class SyncedItemResolver:
+    # memoizes get_synced_item() lookups keyed on (linked item id, project id). negative results
+    # ("no synced item" and "multiple synced items") are stored as None so they are not retried.
+    def __init__(self, pool):
+        self.pool = pool
+        self.resolved = {}
+
+    def prefetch(self, linked_item_ids, project_id):
+        # resolve every id we have not seen yet once, running the api calls in parallel
+        pending = [linked_item_id for linked_item_id in linked_item_ids
+                   if (str(linked_item_id), int(project_id)) not in self.resolved]
+        if len(pending) == 0:
+            return
+        corrected_ids = self.pool.map(lambda linked_item_id: get_synced_item(linked_item_id, project_id), pending)
+        for linked_item_id, corrected_item_id in zip(pending, corrected_ids):
+            self.resolved[(str(linked_item_id), int(project_id))] = corrected_item_id
+
+    def get(self, linked_item_id, project_id):
+        key = (str(linked_item_id), int(project_id))
+        if key not in self.resolved:
+            self.resolved[key] = get_synced_item(linked_item_id, project_id)
+        return self.resolved[key]
 
-locked_item_data = dict()
 
 def init_jama_client():
     # do we have credentials in the config?
@@ -32,8 +880,14 @@ def init_jama_client():
         password = get_password(credentials_dict)
         disable_ssl = get_disable_ssl(credentials_dict)
         jama_client = JamaClient(instance_url, credentials=(username, password), oauth=oauth, verify=not disable_ssl)
+        # so this first request is paced and retried like every other
+        mount_session_adapter(jama_client, get_max_concurrency())
         jama_client.get_available_endpoints()
         return jama_client
+    except (APIServerException, TooManyRequestsException, CircuitOpenError) as e:
+        # the credentials may well be fine, there is no point asking for them again
+        logger.error('Unable to reach <' + get_instance_url(credentials_dict) + '>. Exception: ' + str(e))
+        sys.exit(1)
     except APIException:
         # we cant do things without the API so let's kick out of the execution.
         logger.info('Error: invalid Jama credentials, check they are valid in the config.ini file.')
@@ -57,7 +911,7 @@ def get_instance_url(credentials_object):
         if instance_url.endswith('/'):
             instance_url = instance_url[:-1]
         # user forget to put the "https://" bit?
-        if not instance_url.startswith('https://') or instance_url.startswith('http://'):
+        if not (instance_url.startswith('https://') or instance_url.startswith('http://')):
             # if forgotten then ASSuME that this is an https server.
             instance_url = 'https://' + instance_url
         # also allow for shorthand cloud instances
@@ -146,53 +1000,353 @@ def get_display_attribute():
         return 'documentKey'
 
 
-def get_project_id():
+def get_item_cache_size():
+    # this parameter is optional, zero means the item cache is unbounded. if not specified the cache is
+    # unbounded, except in streaming mode where it is kept to STREAMING_ITEM_CACHE_SIZE items
+    try:
+        return max(int(config['PARAMETERS']['item cache size']), 0)
+    except:
+        return STREAMING_ITEM_CACHE_SIZE if get_streaming_mode() else 0
+
+
+def get_max_concurrency():
+    # this parameter is optional, the number of api requests that may run at the same time
+    try:
+        return max(int(config['PARAMETERS']['max concurrency']), 1)
+    except:
+        return 8
+
+
+def get_seed_user_cache():
+    # this parameter is optional, if not specified then lock owners are only looked up as needed
+    try:
+        user_input = config['PARAMETERS']['seed user cache'].lower()
+        user_input = user_input.strip()
+        return user_input == 'true' or user_input == 'yes' or user_input == 'y'
+    except:
+        return False
+
+
+def get_user_cache_file():
+    # this parameter is optional, if not specified then lock owner names are not saved between runs
+    try:
+        user_input = config['PARAMETERS']['user cache file'].strip()
+        return user_input if user_input != '' else None
+    except:
+        return None
+
+
+def get_streaming_mode():
+    # this parameter is optional, if not specified then all items are retrieved before processing starts
     try:
-        return int(config['PARAMETERS']['project id'])
+        user_input = config['PARAMETERS']['streaming mode'].lower()
+        user_input = user_input.strip()
+        return user_input == 'true' or user_input == 'yes' or user_input == 'y'
+    except:
+        return False
+
+
+def get_candidate_search():
+    # this parameter is optional, if not specified then every item in the project is downloaded
+    try:
+        user_input = config['PARAMETERS']['candidate search'].lower()
+        user_input = user_input.strip()
+        return user_input == 'true' or user_input == 'yes' or user_input == 'y'
+    except:
+        return False
+
+
+def get_page_size():
+    # this parameter is optional, the jama api returns at most 50 items per page
+    try:
+        return min(max(int(config['PARAMETERS']['page size']), 1), 50)
+    except:
+        return 50
+
+
+def get_max_retries():
+    # this parameter is optional, how many times a throttled or failed api request is retried
+    try:
+        return max(int(config['PARAMETERS']['max retries']), 0)
+    except:
+        return 3
+
+
+def get_project_ids(valid_project_ids):
+    # this field is required, either a single project id, a comma separated list of ids, or "all"
+    try:
+        user_input = config['PARAMETERS']['project id'].strip()
     except:
         logger.error("missing project id... please provide a project id in the config ini")
         sys.exit()
 
+    if user_input.lower() == 'all':
+        return sorted(valid_project_ids)
+
+    try:
+        project_ids = [int(project_id) for project_id in user_input.split(',') if project_id.strip() != '']
+    except ValueError:
+        logger.error("invalid project id... please provide a project id, a comma separated list of ids or 'all'")
+        sys.exit()
+    if len(project_ids) == 0:
+        logger.error("missing project id... please provide a project id in the config ini")
+        sys.exit()
+
+    # let's validate the project ids here before continuing
+    for project_id in project_ids:
+        if project_id not in valid_project_ids:
+            logger.error('Invalid project id [' + str(project_id) + '] provided in the config.ini')
+            sys.exit()
+
+    # drop any duplicates, keeping the order they were listed in
+    return list(dict.fromkeys(project_ids))
+
+
+def get_checkpoint_file():
+    # this parameter is optional, leave it blank to turn the scan checkpoint off
+    try:
+        user_input = config['PARAMETERS']['checkpoint file'].strip()
+        return user_input if user_input != '' else None
+    except:
+        return 'scan_checkpoint.db'
+
+
+def get_journal_file():
+    # this parameter is optional, leave it blank to turn the fix journal off
+    try:
+        user_input = config['PARAMETERS']['journal file'].strip()
+        return user_input if user_input != '' else None
+    except:
+        return 'fix_journal.jsonl'
+
+
+def get_scan_workers():
+    # this parameter is optional, how many worker processes parse and rewrite the rich text fields.
+    # 0 (the default) does this work in the main process
+    try:
+        return max(int(config['PARAMETERS']['scan workers']), 0)
+    except:
+        return 0
+
+
+def get_max_requests_per_second():
+    # this parameter is optional, 0 (the default) leaves the request rate up to max concurrency
+    try:
+        max_rate = float(config['PARAMETERS']['max requests per second'])
+        return max_rate if max_rate > 0 else None
+    except:
+        return None
+
+
+def get_max_error_rate():
+    # this parameter is optional, the share of recent API requests that may fail before the run is stopped
+    try:
+        return min(max(float(config['PARAMETERS']['max error rate']), 0.0), 1.0)
+    except:
+        return 0.5
+
+
+def get_locked_items_report():
+    # this parameter is optional, the file extension picks the format (.xlsx, .csv or .jsonl)
+    try:
+        user_input = config['PARAMETERS']['locked items report'].strip()
+        return user_input if user_input != '' else 'locked_items.xlsx'
+    except:
+        return 'locked_items.xlsx'
+
+
+def get_response_cache_file():
+    # this parameter is optional, leave it blank to turn the response cache off
+    try:
+        user_input = config['PARAMETERS']['response cache file'].strip()
+        return user_input if user_input != '' else None
+    except:
+        return None
+
+
+def get_response_cache_size():
+    # this parameter is optional, the most the response cache keeps on disk in MB
+    try:
+        return max(float(config['PARAMETERS']['response cache size']), 0.0) * 1024 * 1024
+    except:
+        return 100 * 1024 * 1024
+
+
+def get_response_cache_ttls():
+    # this parameter is optional, "endpoint: seconds" pairs that override the default ttl of each endpoint
+    ttls = dict(RESPONSE_CACHE_TTLS)
+    try:
+        for pair in config['PARAMETERS']['response cache ttl'].split(','):
+            if pair.strip() == '':
+                continue
+            endpoint, seconds = pair.split(':')
+            if endpoint.strip() in ttls:
+                ttls[endpoint.strip()] = max(float(seconds), 0.0)
+            else:
+                logger.warning('Unknown response cache endpoint [' + endpoint.strip() + '] ignored')
+    except:
+        pass
+    return ttls
+
+
+def get_max_concurrent_projects():
+    # this parameter is optional, how many projects are processed at the same time in batch mode
+    try:
+        return max(int(config['PARAMETERS']['max concurrent projects']), 1)
+    except:
+        return 1
+
+
+def mount_session_adapter(jama_client, pool_size):
+    # every request goes through the request scheduler and the response cache, if there is one. requests
+    # also only keeps 10 connections per host alive
+    # by default, make room for every worker so concurrent requests reuse keep-alive connections.
+    # py_jama_rest_client does not expose its session, so reach in for it
+    try:
+        session = jama_client._JamaClient__core._Core__session
+    except AttributeError:
+        logger.warning('Unable to set up the HTTP session, API requests will not be rate limited')
+        return
+    adapter = ScheduledHTTPAdapter(request_scheduler, response_cache, pool_connections=pool_size,
+                                   pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fixes broken links in rich text fields.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only analyze items that changed since the last run, or were locked or unresolved')
+    run_modes = parser.add_mutually_exclusive_group()
+    run_modes.add_argument('--resume', action='store_true',
+                           help='finish the patches planned by an interrupted run from the fix journal, '
+                                'without scanning')
+    run_modes.add_argument('--dry-run', nargs='?', const='fix_plan.jsonl', metavar='PLAN_FILE',
+                           help='scan and write the planned changes to PLAN_FILE (default fix_plan.jsonl) '
+                                'without patching anything')
+    run_modes.add_argument('--apply', nargs='?', const='fix_plan.jsonl', metavar='PLAN_FILE',
+                           help='make the changes planned by a dry run, without scanning')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile, the results are written next to the log file')
+    return parser.parse_args()
+
 
 def init_logger():
-    # Setup logging
+    # Setup logging. records are put on a queue and a background thread writes them to the JSON Lines log
+    # file and the console, so the scan and the patches never wait on log i/o
     try:
         os.makedirs('logs')
     except FileExistsError:
         pass
 
     current_date_time = datetime.datetime.now().strftime('%m-%d-%Y_%H-%M-%S')
-    log_file = 'logs/' + str(current_date_time) + '.log'
+    log_file = 'logs/' + str(current_date_time) + '.jsonl'
 
-    logging.basicConfig(filename=log_file, level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
-                        datefmt='%H:%M:%S')
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    file_handler.setFormatter(JsonLinesFormatter())
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), file_handler, logging.StreamHandler(sys.stdout))
+    listener.start()
+    # whatever is still on the queue is written out on the way out, however the run ends
+    atexit.register(listener.stop)
 
     logger = logging.getLogger()
-    logger.addHandler(logging.StreamHandler(sys.stdout))
-    return logger
+    logger.setLevel(logging.INFO)
+    logger.addHandler(DeferredQueueHandler(listener.queue))
+    return logger, listener
+
+
+def start_worker_log_listener():
+    # the scan workers put their records on a queue shared with this process, written out by the same handlers
+    worker_log_queue = multiprocessing.get_context('spawn').Queue()
+    listener = logging.handlers.QueueListener(worker_log_queue, *log_listener.handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return worker_log_queue
+
+
+def get_log_file():
+    return [handler.baseFilename for handler in log_listener.handlers if isinstance(handler, logging.FileHandler)][0]
 
 
-def get_item_field(item_id, field_key):
+def get_log_verbosity():
+    # this parameter is optional, one of "run", "item" (the default) or "link"
     try:
-        item = client.get_item(item_id)
-        return item['fields'][field_key]
+        user_input = config['PARAMETERS']['log verbosity'].lower()
+        user_input = user_input.strip()
+        return LOG_VERBOSITY_LEVELS.get(user_input, ITEM_DETAIL)
+    except:
+        return ITEM_DETAIL
+
+
+def get_phase_seconds(metadata_seconds, run_stats):
+    # STEP ZERO to STEP THREE, in batch mode these add up the time spent on every project
+    return collections.OrderedDict([('metadata', metadata_seconds),
+                                    ('fetch', run_stats['fetch seconds']),
+                                    ('analysis', run_stats['index seconds'] + run_stats['scan seconds']),
+                                    ('patch', run_stats['patch seconds'])])
+
+
+def round_stats(stats):
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in sorted(stats.items())}
+
+
+def write_run_summary(path, total_seconds, phase_seconds, run_stats):
+    # everything measured during the run, as JSON so runs can be compared
+    summary = {
+        'totalSeconds': round(total_seconds, 3),
+        'phaseSeconds': {phase: round(seconds, 3) for phase, seconds in phase_seconds.items()},
+        'run': round_stats(run_stats),
+        'projects': {str(project_id): round_stats(stats) for project_id, stats in project_stats.items()},
+        'api': api_call_stats.to_dict(),
+        'fields': {field_name: round_stats(stats) for field_name, stats in sorted(field_stats.items())},
+        'itemCache': {'hits': item_cache.hits, 'misses': item_cache.misses},
+        'requests': request_scheduler.to_dict(),
+        'responseCache': response_cache.to_dict() if response_cache is not None else None
+    }
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def call_api(api_method, *args):
+    # call a JamaClient method and record how it went. throttled and failed requests have already been retried
+    # one request at a time by ScheduledHTTPAdapter, so an APIException here is final. so is a
+    # requests.exceptions.RequestException, which JamaClient lets through when the connection keeps failing
+    call_start_time = time.time()
+    try:
+        result = api_method(*args)
+    except (APIException, requests.exceptions.RequestException):
+        api_call_stats.record(api_method.__name__, time.time() - call_start_time, True)
+        raise
+    api_call_stats.record(api_method.__name__, time.time() - call_start_time, False)
+    return result
+
+
+def get_display_value(item_id):
+    try:
+        return item_cache.get(item_id)
     except APIException as e:
         if e.reason is None:
-            logger.error('Unable to retrieve name data on item [' + item_id + ']  with exception:' + str(e.reason))
+            logger.error('Unable to retrieve name data on item [' + str(item_id) + ']  with exception:' + str(e.reason))
         else:
-            logger.error('Unable to retrieve name data on item [' + item_id + ']')
+            logger.error('Unable to retrieve name data on item [' + str(item_id) + ']')
 
         return None
+    except requests.exceptions.RequestException as e:
+        logger.error('Unable to retrieve name data on item [' + str(item_id) + '] with exception: ' + str(e))
+        return None
 
 
 def get_synced_item(item_id, project_id):
     try:
-        synced_items = client.get_items_synceditems(item_id)
-    except APIException as e:
+        synced_items = call_api(client.get_items_synceditems, item_id)
+    except (APIException, requests.exceptions.RequestException) as e:
         logger.error('Unable to retrieve synced items for item id:[' + str(item_id) + ']. Exception: ' + str(e))
         return None
 
+    return select_synced_item(item_id, synced_items, project_id)
+
+
+def select_synced_item(item_id, synced_items, project_id):
     if synced_items is None or len(synced_items) == 0:
         logger.error('Unable to find any synced items for original item with ID:[' + item_id + ']')
         return None
@@ -213,40 +1367,1049 @@ def get_synced_item(item_id, project_id):
         return None
 
 
-def start_workbook():
-    # Create workbook using openpyxl
-    workbook = openpyxl.Workbook()
-    sheet = workbook.active
+def get_items_page(project_id, start_index, page_size):
+    # fetch a single page of the project's items. py_jama_rest_client only exposes get_items(), which pages
+    # through the whole project before returning, so go through its core for one page at a time
+    params = {'project': project_id, 'startAt': start_index, 'maxResults': page_size}
+    try:
+        response = client._JamaClient__core.get('items', params=params)
+    except CoreException as err:
+        raise APIException(str(err))
+    JamaClient._JamaClient__handle_response_status(response)
+    return response.json()
 
-    # Write the headers
-    sheet['A1'] = "ID"
-    sheet['B1'] = "Locked By"
-    sheet['C1'] = "URL Link to Item"
 
-    return workbook
+def get_abstract_items_page(project_id, contains, start_index, page_size):
+    # fetch a single page of the project's items whose text contains the search term, the same way as
+    # get_items_page(). the abstract items search returns the whole item, so no second fetch is needed
+    params = {'project': project_id, 'contains': contains, 'startAt': start_index, 'maxResults': page_size}
+    try:
+        response = client._JamaClient__core.get('abstractitems', params=params)
+    except CoreException as err:
+        raise APIException(str(err))
+    JamaClient._JamaClient__handle_response_status(response)
+    return response.json()
+
+
+def build_candidate_search_terms(instance):
+    # text every jama link holds, absolute links have the instance host and both url formats have the
+    # project id. an item that has neither in any field has no jama links to fix
+    return [urlparse.urlparse(instance).hostname, 'projectId=']
+
+
+def search_candidate_items(project_id, page_size):
+    # returns (items in the project that may hold a jama link, total items in project). items found by
+    # more than one search term are only kept once
+    total_items = call_api(get_items_page, project_id, 0, 1)['meta']['pageInfo'].get('totalResults')
+    candidates = collections.OrderedDict()
+    for search_term in candidate_search_terms:
+        start_index = 0
+        total_results = None
+        while total_results is None or start_index < total_results:
+            page_json = call_api(get_abstract_items_page, project_id, search_term, start_index, page_size)
+            total_results = page_json['meta']['pageInfo'].get('totalResults')
+            item_page = page_json.get('data')
+            if not item_page:
+                break
+            start_index += len(item_page)
+            for item in item_page:
+                # the search also finds test plans, cycles and runs, only items are scanned
+                if item.get('type', 'items') == 'items' and item.get('id') not in candidates:
+                    candidates[item.get('id')] = item
+    return list(candidates.values()), total_items
+
+
+def fetch_candidate_items(project_id, stats, show_progress):
+    # STEP ONE with the candidate search, returns None if the instance could not search so the caller
+    # falls back to downloading the whole project
+    spinner_message = 'Searching project ID:[' + str(project_id) + '] for items with jama links'
+    spinner = Halo(text=spinner_message, spinner='dots', enabled=show_progress)
+    spinner.start()
+    fetch_start_time = time.time()
+    try:
+        items, total_items = search_candidate_items(project_id, get_page_size())
+    except APIException as e:
+        logger.warning('Candidate search failed for project ID:[' + str(project_id) + '], retrieving every item '
+                       'instead. Exception: ' + str(e))
+        return None
+    finally:
+        stats['fetch seconds'] += time.time() - fetch_start_time
+        spinner.stop()
+    if len(items) == 0 and total_items:
+        # an instance whose search index is missing or still being built finds nothing at all, which can't be
+        # told apart from a project without links, so check every item rather than trust it
+        logger.warning('Candidate search found no items with jama links in the ' + str(total_items) +
+                       ' items of project ID:[' + str(project_id) + '], the search index may be incomplete. '
+                       'Retrieving every item instead')
+        return None
+    logger.info('Candidate search found ' + str(len(items)) + ' of ' + str(total_items) +
+                ' items in project ID:[' + str(project_id) + '] that may hold jama links')
+    return items, total_items
+
+
+def iter_item_pages(project_id, page_size):
+    # yields (page of items, total items in project) so each page can be processed and released in turn
+    start_index = 0
+    total_results = None
+    while total_results is None or start_index < total_results:
+        page_json = call_api(get_items_page, project_id, start_index, page_size)
+        total_results = page_json['meta']['pageInfo'].get('totalResults')
+        item_page = page_json.get('data')
+        if not item_page:
+            break
+        start_index += len(item_page)
+        yield item_page, total_results
+
+
+def time_item_pages(item_pages, stats):
+    # passes the pages through, adding the time spent waiting on each one to the STEP ONE time in stats
+    item_pages = iter(item_pages)
+    while True:
+        fetch_start_time = time.time()
+        item_page = next(item_pages, None)
+        stats['fetch seconds'] += time.time() - fetch_start_time
+        if item_page is None:
+            return
+        yield item_page
+
+
+def index_anchor_spans(value, hyperlinks):
+    # map each anchor's html to the (start, end) offsets of every copy of it in the field value. the parser
+    # based extractors don't report offsets, so for those the offsets come from one raw scan of the field
+    if len(hyperlinks) > 0 and hyperlinks[0].start is None:
+        hyperlinks = extract_links_tokenizer(value)
+    anchor_spans = {}
+    for hyperlink in hyperlinks:
+        anchor_spans.setdefault(hyperlink.html, []).append((hyperlink.start, hyperlink.end))
+    return anchor_spans
+
+
+def find_anchor_spans(value, hyperlink_string):
+    # (start, end) offsets of every occurrence of an anchor that index_anchor_spans() could not match as is
+    spans = []
+    if hyperlink_string in value:
+        start = value.find(hyperlink_string)
+        while start != -1:
+            spans.append((start, start + len(hyperlink_string)))
+            start = value.find(hyperlink_string, start + len(hyperlink_string))
+        return spans
+
+    # otherwise we have a character encoding problem here. the parser re-encodes the link text, so look for
+    # anchors with the same start tag whose text, as stored up to the next "<", decodes to the same text
+    start_link = get_start_tag(hyperlink_string)
+    link_text = html.unescape(get_link_text(hyperlink_string))
+    start = value.find(start_link)
+    while start != -1:
+        end_index = value.find('<', start + len(start_link))
+        end_match = end_tag_pattern.match(value, end_index) if end_index != -1 else None
+        if end_match is not None and html.unescape(value[start + len(start_link):end_index]) == link_text:
+            spans.append((start, end_match.end()))
+        start = value.find(start_link, start + len(start_link))
+    return spans
+
+
+def get_start_tag(hyperlink_string):
+    return hyperlink_string[0:hyperlink_string.index('>') + 1]
+
+
+def get_link_text(hyperlink_string):
+    # the markup between the start tag and the closing tag, however the closing tag is written (</a>, </A>, </a >)
+    return hyperlink_string[hyperlink_string.index('>') + 1:hyperlink_string.rindex('<')]
+
+
+def is_same_link_text(link_text, display_value):
+    # the link text is markup and the display value is plain text, so "A &amp; B" and "A & B" are the same text
+    return html.unescape(link_text) == display_value
+
+
+def apply_edits(value, edits):
+    # build the new field value in a single pass from (start, end, replacement) edits on the original value
+    pieces = []
+    position = 0
+    for start, end, replacement in sorted(edits):
+        # each anchor is only edited once, so an overlapping edit would be a second edit of the same text
+        if start < position:
+            continue
+        pieces.append(value[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(value[position:])
+    return ''.join(pieces)
+
+
+def build_link_prefilter(instance):
+    # a field can only hold a jama link if it has an anchor tag or mentions the instance host
+    hostname = urlparse.urlparse(instance).hostname
+    return re.compile(r'<a[\s>]|' + re.escape(hostname), re.IGNORECASE)
+
+
+def may_contain_jama_link(value):
+    # cheap check so only fields that could hold a jama link are handed to the html parser
+    return isinstance(value, str) and link_prefilter.search(value) is not None
+
+
+def extract_links_bs4(value):
+    soup = BeautifulSoup(value, 'html.parser')
+    return [Anchor(hyperlink.get('href'), str(hyperlink), None, None) for hyperlink in soup.find_all('a')]
+
+
+def extract_links_lxml(value):
+    # lxml is an optional dependency, get_link_extractor() checks it is installed before this is used
+    import lxml.html
+    fragment = lxml.html.fragment_fromstring(value, create_parent='div')
+    return [Anchor(hyperlink.get('href'), lxml.html.tostring(hyperlink, encoding='unicode', with_tail=False),
+                   None, None) for hyperlink in fragment.iter('a')]
+
+
+def extract_links_tokenizer(value):
+    # scan the raw markup for anchors. the anchor html is the exact slice of the field value, so it
+    # can always be found in the field again, and the offsets are reported for the rewrite
+    anchors = []
+    for match in anchor_pattern.finditer(value):
+        start_tag = match.group(0)[:match.group(0).index('>') + 1]
+        href_match = href_pattern.search(start_tag)
+        href = None
+        if href_match is not None:
+            href = html.unescape(next(group for group in href_match.groups() if group is not None))
+        anchors.append(Anchor(href, match.group(0), match.start(), match.end()))
+    return anchors
+
+
+def align_anchors(value, hyperlinks):
+    # the html parsers re-serialize each anchor, which does not always match the field markup (single quoted
+    # attributes, a raw "&" in a url or the link text, upper case tags). when a raw scan finds the same anchors
+    # with the same hrefs, use its exact slices and offsets instead, so every extractor makes the same changes.
+    # otherwise the parser's anchors are kept and located in the field by find_anchor_spans()
+    if len(hyperlinks) == 0 or hyperlinks[0].start is not None:
+        return hyperlinks
+    raw_hyperlinks = extract_links_tokenizer(value)
+    if [hyperlink.href for hyperlink in raw_hyperlinks] != [hyperlink.href for hyperlink in hyperlinks]:
+        return hyperlinks
+    return raw_hyperlinks
+
+
+link_extractors = {
+    'bs4': extract_links_bs4,
+    'lxml': extract_links_lxml,
+    'tokenizer': extract_links_tokenizer
+}
+
+
+def get_link_extractor():
+    # this parameter is optional, defaults to the beautiful soup html parser
+    try:
+        user_input = config['PARAMETERS']['link extractor'].lower().strip()
+    except:
+        user_input = 'bs4'
+    if user_input not in link_extractors:
+        logger.error("invalid 'link extractor' parameter... please use one of: " + ', '.join(link_extractors))
+        sys.exit()
+    if user_input == 'lxml':
+        try:
+            import lxml.html
+        except ImportError:
+            logger.error("the lxml link extractor requires lxml, install it with 'pip install lxml'")
+            sys.exit()
+    return link_extractors[user_input]
+
+
+def hash_item_fields(item):
+    # hash of the rich text fields that could hold a link, kept in the checkpoint alongside the modified date
+    fields = item.get('fields')
+    digest = hashlib.sha1()
+    for key in sorted(fields):
+        if may_contain_jama_link(fields[key]):
+            digest.update(key.encode('utf-8') + b'\0' + fields[key].encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def is_unchanged_since_last_scan(previous_row, checkpoint_row):
+    # items that were clean or fixed last time and have not changed since have nothing new to find
+    if previous_row is None:
+        return False
+    modified_date, fields_hash, outcome = previous_row
+    return (modified_date, fields_hash) == checkpoint_row and outcome in ('clean', 'fixed')
+
+
+def get_linked_ids(parsed_link):
+    # pull the (project id, item id) pair out of a jama link. raises if the link is not in a format we know
+    url_parameters = urlparse.parse_qs(parsed_link.query)
+    # do we have paramaters from the url? new url formatting from jama that we need to cover
+    if not url_parameters:
+        # e.g fragment... /items/10140?projectId=77'
+        link_fragment = parsed_link.fragment
+        linked_project_id = link_fragment.split('projectId=')[1]
+        linked_item_id = link_fragment.split('?')[0].split('items/')[1]
+    # otherwise assume that this url will have proper params we can access
+    else:
+        linked_project_id = url_parameters['projectId'][0]
+        linked_item_id = url_parameters['docId'][0]
+    # both ids must be numeric, raises ValueError otherwise
+    int(linked_project_id)
+    int(linked_item_id)
+    return linked_project_id, linked_item_id
+
+
+def is_jama_link(hyperlink):
+    parsed_link = urlparse.urlparse(hyperlink.href)
+    return parsed_link.hostname is not None and parsed_link.hostname in instance_url
+
+
+def parse_item_links(item, project_id):
+    # parse each rich text field of an item once, the anchors are used by both the link target index and the
+    # scan. returns {field name: (number of anchors, the anchors that are jama links)} for every field that may
+    # hold a jama link, the other anchors are not needed after this
+    field_links = {}
+    fields = item.get('fields')
+    for key in fields:
+        value = fields[key]
+        if not may_contain_jama_link(value):
+            project_stats[project_id]['fields skipped'] += 1
+            continue
+        project_stats[project_id]['fields parsed'] += 1
+        parse_start_time = time.time()
+        hyperlinks = align_anchors(value, extract_links(value))
+        parse_seconds = time.time() - parse_start_time
+        project_stats[project_id]['parse seconds'] += parse_seconds
+        project_stats[project_id]['html bytes'] += len(value)
+        field_stats[key]['fields parsed'] += 1
+        field_stats[key]['parse seconds'] += parse_seconds
+        field_stats[key]['html bytes'] += len(value)
+        field_links[key] = (len(hyperlinks), [hyperlink for hyperlink in hyperlinks if is_jama_link(hyperlink)])
+    return field_links
+
+
+def collect_link_targets(item_links):
+    # find every distinct (linked project id, linked item id) pair that a jama link in the parsed items points at
+    link_targets = set()
+    for field_links in item_links:
+        for anchor_count, hyperlinks in field_links.values():
+            for hyperlink in hyperlinks:
+                try:
+                    link_targets.add(get_linked_ids(urlparse.urlparse(hyperlink.href)))
+                except Exception:
+                    # the scan will log this link as unparseable, nothing to resolve here
+                    continue
+    return link_targets
+
+
+def parse_items(item_list, project_id):
+    # returns the parsed links of every item, in item_list order, and the link targets they point at
+    item_links = [parse_item_links(item, project_id) for item in item_list]
+    return item_links, collect_link_targets(item_links)
+
+
+def build_link_target_index(link_target_pairs, project_id, link_targets):
+    # resolve every link target pair that is not in link_targets yet, so the scan that follows can rewrite
+    # the fields without going back to the api. link_targets maps the (linked project id, linked item id)
+    # pairs to a LinkTarget, and is added to in place
+    pairs = [pair for pair in link_target_pairs if pair not in link_targets]
+
+    # links to the project's own items already point at the right item, the rest go through the synced items
+    corrected_item_ids = {}
+    foreign_item_ids = set()
+    for linked_project_id, linked_item_id in pairs:
+        if int(linked_project_id) == int(project_id):
+            corrected_item_ids[(linked_project_id, linked_item_id)] = int(linked_item_id)
+        else:
+            foreign_item_ids.add(linked_item_id)
+    synced_item_resolver.prefetch(foreign_item_ids, project_id)
+    for linked_project_id, linked_item_id in pairs:
+        if int(linked_project_id) != int(project_id):
+            corrected_item_ids[(linked_project_id, linked_item_id)] = synced_item_resolver.get(linked_item_id,
+                                                                                               project_id)
+
+    # the link text is only rewritten in text mode. the project's own items are already in the item cache,
+    # anything else is fetched on the worker pool
+    display_values = {}
+    if get_text_mode():
+        display_item_ids = list(set(corrected_item_id for corrected_item_id in corrected_item_ids.values()
+                                    if corrected_item_id is not None))
+        field_values = api_pool.map(get_display_value, display_item_ids)
+        display_values = dict(zip(display_item_ids, field_values))
+
+    for pair, corrected_item_id in corrected_item_ids.items():
+        link_targets[pair] = LinkTarget(corrected_item_id, display_values.get(corrected_item_id))
+    return len(pairs)
+
+
+def build_item_url(item_id, project_id):
+    return instance_url + "/perspective.req#/items/" + str(item_id) + "?projectId=" + str(project_id)
+
+
+def scan_item(item, project_id, link_targets, field_links):
+    # find the bad links on a single item, returns the data needed to patch its broken fields and whether the
+    # item is locked with broken links. field_links are the item's anchors from parse_item_links() and every
+    # link target must already be in link_targets, this makes no api calls so it can run in a scan worker process
+    broken_links = []
+    item_id = item.get('id')
+    fields = item.get('fields')
+
+    # Getting lock properties, locked items are logged to Excel by the caller
+    item_lock_properties = item.get('lock')
+    item_locked_with_broken_links = False
+    # shared by the fixes of every field of this item
+    item_fix = None
+
+    for key, (anchor_count, hyperlinks) in field_links.items():
+        original_value = fields[key]
+        value = fields[key]
+        bad_link_count = 0
+        # link edits against the original value, applied in one pass when the patch is sent
+        edits = []
+
+        if anchor_count > 0:
+            logger.log(LINK_DETAIL, 'Processing %s hyperlinks on item ID:[%s] on field name:[%s]',
+                       anchor_count, item_id, key)
+
+        counter = 0
+
+        # remove any duplicate entries in this list, the offsets of every copy are kept in anchor_spans
+        anchor_spans = index_anchor_spans(value, hyperlinks)
+        unique_hyperlinks = {}
+        for hyperlink in hyperlinks:
+            unique_hyperlinks.setdefault(hyperlink.html, hyperlink)
+        hyperlinks = list(unique_hyperlinks.values())
+
+        # iterate over all the hyperlinks
+        for hyperlink in hyperlinks:
+            counter += 1
+            href = hyperlink.href
+            parsed_link = urlparse.urlparse(href)
+            hyperlink_string = hyperlink.html
+
+            # only the jama links are kept by parse_item_links()
+            try:
+                linked_project_id, linked_item_id = get_linked_ids(parsed_link)
+            except Exception as e:
+                logger.error('failed to get url parameters, error: ' + str(e))
+                logger.error('unable to identify project and item ids from link <' +
+                             href + '> skipping current link...')
+                project_outcomes[project_id][item_id] = 'unresolved'
+                continue
+
+            logger.log(LINK_DETAIL, '--- link %s --- Processing link with item ID:[%s] and project ID:[%s]...',
+                       counter, linked_item_id, linked_project_id)
+
+            # the synced item (or the item itself for links within this project) and its display attribute
+            link_target = link_targets[(linked_project_id, linked_item_id)]
+            corrected_item_id = link_target.corrected_item_id
+
+            if int(linked_project_id) == int(project_id):
+                # we have a valid link here, but do we have a mismatched name?
+
+                # are we running text mode? if so were updating the name
+                if get_text_mode():
+                    if link_target.display_value is None:
+                        logger.error('Unable to get target item data on item ID:[' + str(linked_item_id) +
+                                     '], skipping link')
+                        project_outcomes[project_id][item_id] = 'unresolved'
+                        continue
+                    sourceName = get_link_text(hyperlink_string)
+                    targetName = link_target.display_value
+
+                    if is_same_link_text(sourceName, targetName):
+                        logger.log(LINK_DETAIL, "valid link detected. skipping.")
+                        continue
+
+                # otherwise we already have a valid link, quit
+                else:
+                    logger.log(LINK_DETAIL, "valid link detected. skipping.")
+                    continue
+            elif corrected_item_id is None:
+                logger.error('Unable to find synced item, skipping link')
+                project_outcomes[project_id][item_id] = 'unresolved'
+                continue
+
+            # we must have a single item id before continuing here.
+            # also does this project id param not match the current project?
+            # if so then this is a bad link
+            # there could potentially be more than one bad link per field value. so
+            # let's keep track of that.
+            if get_link_mode():
+                logger.log(LINK_DETAIL, 'Identified incorrect link, will update... item ID:[%s]', corrected_item_id)
+
+            # is text mode enabled? if so then update the link name here
+            corrected_item_name = None
+            if get_text_mode():
+                corrected_item_name = link_target.display_value
+                if corrected_item_name is None:
+                    logger.error('Unable to get the display attribute of item ID:[' + str(corrected_item_id) +
+                                 '], skipping link')
+                    project_outcomes[project_id][item_id] = 'unresolved'
+                    continue
+                # are we running only text mode here?
+                if not get_link_mode():
+                    # dont do any redundant updates
+                    sourceName = get_link_text(hyperlink_string)
+                    # skip this link if it's already matching here (no work to be done)
+                    if is_same_link_text(sourceName, corrected_item_name):
+                        continue
+
+            # otherwise text mode is disabled. so use the existing name here.
+            else:
+                try:
+                    corrected_item_name = get_link_text(hyperlink_string)
+                except:
+                    logger.error('failed to resolve link name, this link will not update')
+                    project_outcomes[project_id][item_id] = 'unresolved'
+                    continue
+
+                # let's do the work to change the links name to match the new correct item name
+
+            corrected_hyperlink_string = get_start_tag(hyperlink_string) + corrected_item_name + '</a>'
+
+            #  is link mode enabled?
+            if get_link_mode():
+                corrected_hyperlink_string = corrected_hyperlink_string.replace(
+                    'projectId=' + str(linked_project_id),
+                    'projectId=' + str(project_id))
+                corrected_hyperlink_string = corrected_hyperlink_string.replace('docId=' + str(linked_item_id),
+                                                                                'docId=' + str(
+                                                                                    corrected_item_id))
+                # the fragment format (#/items/10140?projectId=77) has the item id in its path
+                corrected_hyperlink_string = corrected_hyperlink_string.replace(
+                    'items/' + str(linked_item_id) + '?',
+                    'items/' + str(corrected_item_id) + '?')
+
+            # if we have made it this far then let's record an edit for every occurrence of the hyperlink
+            spans = anchor_spans.get(hyperlink_string)
+            if spans is None:
+                spans = find_anchor_spans(original_value, hyperlink_string)
+            if len(spans) == 0:
+                logger.error('unable to locate link in field value, this link will not update')
+                project_outcomes[project_id][item_id] = 'unresolved'
+                continue
+            old_target = (int(linked_project_id), int(linked_item_id))
+            new_target = (int(project_id), int(corrected_item_id)) if get_link_mode() else old_target
+            for start, end in spans:
+                edits.append(LinkEdit(start, end, corrected_hyperlink_string, old_target, new_target))
+            bad_link_count += 1
+
+        # we have a bad link for this item?
+        if len(edits) > 0:
+            # Before we replace the hyperlinks, let's check if it's locked and log it to Excel if so
+            if item_lock_properties['locked']:
+                item_locked_with_broken_links = True
+                logger.log(ITEM_DETAIL, "Item was locked and has a broken link.  Logging to the locked items report...")
+
+            # let's build out an object of all the data we care about for patching and logging
+            else:
+                if item_fix is None:
+                    item_fix = ItemFix(item_id, project_id, str(item.get('documentKey')),
+                                       item_lock_properties.get('lockedBy'))
+                broken_links.append(FieldFix(item_fix, key, original_value, edits, bad_link_count))
+
+    return broken_links, item_locked_with_broken_links
+
+
+def hash_field_value(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def scan_items(item_list, project_id, link_targets):
+    # find the bad links on a list of items, returns a map of item id to the data needed to patch it.
+    # every distinct link target is resolved up front, then the fields are rewritten without any api calls
+    stats = project_stats[project_id]
+    index_start_time = time.time()
+    if scan_pools is not None:
+        # the links are parsed out of each shard of items in a worker process. each shard is pinned to one
+        # worker, which keeps the parsed items until it rewrites them, so only the link targets come back
+        shards = [(next(shard_ids), shard) for shard in shard_items(item_list, len(scan_pools) * 4)]
+        shard_futures = [get_shard_pool(shard_id).submit(parse_item_shard, shard_id, shard, project_id)
+                         for shard_id, shard in shards]
+        try:
+            shard_link_targets = []
+            for future in shard_futures:
+                link_target_pairs, shard_stats, shard_field_stats = future.result()
+                shard_link_targets.append(link_target_pairs)
+                stats.update(shard_stats)
+                for key, counter in shard_field_stats.items():
+                    field_stats[key].update(counter)
+            new_target_count = build_link_target_index(set().union(*shard_link_targets), project_id,
+                                                       link_targets)
+        except:
+            # the shards will not be rewritten, so the workers can let go of them
+            for shard_id, shard in shards:
+                get_shard_pool(shard_id).submit(release_item_shard, shard_id)
+            raise
+    else:
+        item_links, link_target_pairs = parse_items(item_list, project_id)
+        new_target_count = build_link_target_index(link_target_pairs, project_id, link_targets)
+    stats['index seconds'] += time.time() - index_start_time
+    logger.info('Indexed ' + str(new_target_count) + ' new link target(s) in ' +
+                '%.2f' % (time.time() - index_start_time) + ' seconds')
+
+    scan_start_time = time.time()
+    if scan_pools is not None:
+        # each worker only needs the link targets of its own shard. the results are merged in shard order,
+        # so they come out in the same order as item_list no matter which worker finishes first
+        shard_futures = [get_shard_pool(shard_id).submit(scan_item_shard, shard_id, project_id,
+                                                         {pair: link_targets[pair] for pair in pairs})
+                         for (shard_id, shard), pairs in zip(shards, shard_link_targets)]
+        scan_results = []
+        for future in shard_futures:
+            shard_results, shard_stats, shard_outcomes = future.result()
+            scan_results.extend(shard_results)
+            stats.update(shard_stats)
+            project_outcomes[project_id].update(shard_outcomes)
+    else:
+        scan_results = [scan_item(item, project_id, link_targets, field_links)
+                        for item, field_links in zip(item_list, item_links)]
+    stats['scan seconds'] += time.time() - scan_start_time
+
+    broken_items = {}
+    for item, (broken_links, item_locked_with_broken_links) in zip(item_list, scan_results):
+        if item_locked_with_broken_links:
+            # looking up the lock owner's name can take an api call, so this is done here rather than in the scan
+            log_locked_items(str(item.get('documentKey')),
+                             user_directory.get_full_name(item.get('lock').get('lockedBy')),
+                             build_item_url(item.get('id'), project_id))
+            stats['locked items'] += 1
+            project_outcomes[project_id][item.get('id')] = 'locked'
+        if len(broken_links) > 0:
+            if scan_pools is not None:
+                # the fixes from a scan worker come back without the field value, use the item's own
+                for b in broken_links:
+                    b.old_value = item.get('fields').get(b.field_name)
+            broken_items[item.get('id')] = broken_links
+    return broken_items
+
+
+def shard_items(item_list, shard_count):
+    # split item_list into at most shard_count contiguous shards of about the same size
+    shard_size = max(-(-len(item_list) // shard_count), 1)
+    return [item_list[start:start + shard_size] for start in range(0, len(item_list), shard_size)]
+
+
+def get_shard_pool(shard_id):
+    # the scan worker a shard is pinned to
+    return scan_pools[shard_id % len(scan_pools)]
+
+
+def init_scan_worker(parameters, worker_instance_url, worker_log_queue):
+    # sets up the globals the scan needs in a scan worker process. the workers are spawned rather than forked,
+    # so the __main__ block has not run in them
+    global config, instance_url, link_prefilter, extract_links, logger
+    warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
+    config = configparser.ConfigParser()
+    config.read_dict({'PARAMETERS': parameters})
+    # records below the verbosity are dropped here, before they cross over to the main process
+    logger = logging.getLogger()
+    logger.setLevel(get_log_verbosity())
+    logger.addHandler(logging.handlers.QueueHandler(worker_log_queue))
+    instance_url = worker_instance_url
+    link_prefilter = build_link_prefilter(instance_url)
+    extract_links = get_link_extractor()
+
+
+def parse_item_shard(shard_id, item_list, project_id):
+    # runs in a scan worker process. the items and their parsed links are kept for scan_item_shard, only the
+    # link targets go back. the parse stats only reach this process's copy of the globals, so start them
+    # empty and hand them back too
+    project_stats[project_id] = collections.Counter()
+    field_stats.clear()
+    item_links, link_target_pairs = parse_items(item_list, project_id)
+    parsed_shards[shard_id] = (item_list, item_links)
+    return link_target_pairs, project_stats.pop(project_id), dict(field_stats)
+
+
+def scan_item_shard(shard_id, project_id, link_targets):
+    # runs in a scan worker process, on a shard parse_item_shard kept. the stats and outcomes the scan records
+    # only reach this process's copy of the globals, so start them empty and hand them back with the results
+    item_list, item_links = parsed_shards.pop(shard_id)
+    project_stats[project_id] = collections.Counter()
+    project_outcomes[project_id] = {}
+    scan_results = [scan_item(item, project_id, link_targets, field_links)
+                    for item, field_links in zip(item_list, item_links)]
+    # the main process still has the field values, so they are not sent back
+    for broken_links, item_locked_with_broken_links in scan_results:
+        for b in broken_links:
+            b.old_value = None
+    return scan_results, project_stats.pop(project_id), project_outcomes.pop(project_id)
+
+
+def release_item_shard(shard_id):
+    # runs in a scan worker process, drops a shard that will not be rewritten
+    parsed_shards.pop(shard_id, None)
+
+
+def build_patch_list(broken_links):
+    patch_list = []
+    for b in broken_links:
+        payload = {
+            'op': 'replace',
+            'path': '/fields/' + b.field_name,
+            'value': b.build_new_value()
+        }
+        patch_list.append(payload)
+    return patch_list
+
+
+def patch_broken_item(item_id, broken_links):
+    # runs on the worker pool, so each item's new field values are only built once a worker is free to send
+    # them, and let go as soon as the patch is sent
+    return call_api(client.patch_item, item_id, build_patch_list(broken_links))
+
+
+def handle_patch_result(item_id, broken_links, error):
+    # log how patching an item went, error is the exception raised by patch_item or None on success.
+    # returns the outcome for the run summary, one of 'patched', 'locked' or 'failed'
+    logger.log(ITEM_DETAIL, 'Updating link(s) on item ID: [%s]', item_id)
+
+    for b in broken_links:
+        logger.log(ITEM_DETAIL, 'Field with name [%s] contains %s link(s) to be updated', b.field_name, b.link_count)
+
+    item = b.item
+    if error is None:
+        name = item.item_id if item.item_id is not None else "Unknown Item ID"
+        logger.log(ITEM_DETAIL, 'Successfully patched item [%s]', name,
+                   extra={'data': {'itemId': item.item_id, 'outcome': 'patched'}})
+        return 'patched'
+    elif "locked" in str(error):
+        try:
+            log_locked_items(str(item.document_key),
+                             user_directory.get_full_name(item.locked_by),
+                             build_item_url(item.item_id, item.project_id))
+            logger.log(ITEM_DETAIL, "Log locked items method successful for Item ID: %s", item.item_id,
+                       extra={'data': {'itemId': item.item_id, 'outcome': 'locked'}})
+        except Exception as e:
+            logger.error('Failed to log locked items for [' + str(item.item_id) + ']')
+            logger.error('Error: ' + str(e))
+        return 'locked'
+    else:
+        # Failed to patch
+        logger.error('Failed to patch item [' + str(item.item_id) + ']',
+                     extra={'data': {'itemId': item.item_id, 'outcome': 'failed'}})
+        logger.error('API exception response: ' + str(error))
+        return 'failed'
+
+
+def run_project(project_id, show_progress):
+    # STEP ONE to STEP THREE for a single project, the results are added to project_stats[project_id]
+    project_start_time = time.time()
+    stats = project_stats[project_id]
+    try:
+        """
+        STEP ONE - get all items from project
+        """
+        candidate_page = None
+        if get_candidate_search():
+            candidate_page = fetch_candidate_items(project_id, stats, show_progress)
+        if candidate_page is not None:
+            item_pages = [candidate_page]
+        elif get_streaming_mode():
+            logger.info('Streaming items from project ID:[' + str(project_id) + '] ' + str(get_page_size()) +
+                        ' at a time')
+            item_pages = time_item_pages(iter_item_pages(project_id, get_page_size()), stats)
+        else:
+            spinner_message = 'Retrieving all items from project ID:[' + str(project_id) + ']'
+            spinner = Halo(text=spinner_message, spinner='dots', enabled=show_progress)
+            spinner.start()
+            fetch_start_time = time.time()
+            items = call_api(client.get_items, project_id)
+            stats['fetch seconds'] += time.time() - fetch_start_time
+            spinner.stop()
+            logger.info('Retrieving ' + str(len(items)) + ' items from project ID:[' + str(project_id) + ']')
+            item_pages = [(items, len(items))]
+
+        """
+        STEP TWO - iterate over all the retrieved items and find bad links
+        """
+        broken_link_map = {}
+        items_processed = 0
+        # every link target resolved so far in this project, shared by all the pages
+        link_targets = {}
+        # what each item looked like when we scanned it, written to the checkpoint once the project is done
+        checkpoint_rows = {}
+        previous_scan = scan_checkpoint.load(project_id) if scan_checkpoint is not None else {}
+        total_items = 0
+        for page_number, (item_page, total_items) in enumerate(item_pages, start=1):
+            # the display values are only needed to rewrite the link text
+            if get_text_mode():
+                item_cache.seed(item_page)
+            items_to_scan = []
+            for item in item_page:
+                checkpoint_row = (item.get('modifiedDate'), hash_item_fields(item))
+                if args.incremental and is_unchanged_since_last_scan(previous_scan.get(item.get('id')),
+                                                                     checkpoint_row):
+                    stats['items skipped'] += 1
+                    continue
+                checkpoint_rows[item.get('id')] = checkpoint_row
+                items_to_scan.append(item)
+            page_broken_link_map = scan_items(items_to_scan, project_id, link_targets)
+            stats['items with broken links'] += len(page_broken_link_map)
+            items_processed += len(item_page)
+            if get_streaming_mode():
+                logger.info('Processed page ' + str(page_number) + ' of project ID:[' + str(project_id) + '] (' +
+                            str(items_processed) + ' of ' + str(total_items) + ' items)')
+                # in streaming mode each page is fixed as soon as it is scanned, so only one page of fixes is held
+                if len(page_broken_link_map) > 0:
+                    fix_broken_links(project_id, page_broken_link_map, False)
+            else:
+                broken_link_map.update(page_broken_link_map)
+        # let the last page go before the patch stage
+        item_page = None
+        item_pages = None
+        items = None
+        stats['items'] += items_processed - stats['items skipped']
+        stats['items downloaded'] += items_processed
+        stats['project items'] += total_items
+
+        """
+        STEP THREE - fix and log all broken hyperlinks
+        """
+        # streaming mode fixed each page as it went, unless there was nothing to fix
+        if not get_streaming_mode() or stats['items with broken links'] == 0:
+            fix_broken_links(project_id, broken_link_map, show_progress)
+
+        # nothing was fixed in a dry run, so the next incremental run has to look at these items again
+        if scan_checkpoint is not None and fix_plan is None:
+            outcomes = project_outcomes[project_id]
+            scan_checkpoint.record(project_id, [(item_id, modified_date, fields_hash, outcomes.get(item_id, 'clean'))
+                                                for item_id, (modified_date, fields_hash) in checkpoint_rows.items()])
+    except (APIException, CircuitOpenError, requests.exceptions.RequestException) as e:
+        # in batch mode, one failed project should not stop the others
+        stats['failed projects'] += 1
+        logger.error('Failed to process project ID:[' + str(project_id) + ']. Exception: ' + str(e))
+
+    item_cache.release_project(project_id)
+    stats['seconds'] += time.time() - project_start_time
+
+
+def fix_broken_links(project_id, broken_link_map, show_progress):
+    if fix_plan is not None:
+        # dry run, write down what would be changed rather than changing it
+        fix_plan.write(project_id, broken_link_map)
+        logger.info('Planned ' + str(len(broken_link_map)) + ' item(s) to fix in project ID:[' +
+                    str(project_id) + '], written to <' + fix_plan.path + '>')
+    else:
+        # write the plan down before patching anything, so an interrupted run can be resumed from here
+        if fix_journal is not None:
+            fix_journal.plan(project_id, broken_link_map)
+        patch_project(project_id, broken_link_map, show_progress)
+
+
+def patch_project(project_id, broken_link_map, show_progress):
+    # STEP THREE for a single project, patch every item in broken_link_map
+    patch_start_time = time.time()
+    if len(broken_link_map) > 0:
+        # use a progress bar here. this can be a very long-running process
+        bar = None
+        if show_progress:
+            bar = ChargingBar('Updating links ', max=len(broken_link_map),
+                              suffix='%(percent).1f%% - %(eta)ds')
+        # send the patches out on the worker pool. the results are handled on this thread as
+        # they complete, so the log output for each item stays together and the bar stays correct
+        futures = {}
+        for item_id, broken_links in broken_link_map.items():
+            futures[api_pool.submit(patch_broken_item, item_id, broken_links)] = item_id
+
+        for future in as_completed(futures):
+            item_id = futures[future]
+            try:
+                future.result()
+                finish_patch(project_id, item_id, broken_link_map[item_id], None)
+            except (APIException, requests.exceptions.RequestException) as error:
+                finish_patch(project_id, item_id, broken_link_map[item_id], error)
+            if bar is not None:
+                bar.next()
+        if bar is not None:
+            bar.finish()
+        logger.info('updated ' + str(len(broken_link_map)) + ' link(s) in project ID:[' + str(project_id) + ']')
+    else:
+        logger.info('There are zero links to be corrected in project ID:[' + str(project_id) + ']')
+    project_stats[project_id]['patch seconds'] += time.time() - patch_start_time
+
+
+def finish_patch(project_id, item_id, broken_links, error):
+    # everything that happens once a patch_item call has completed, error is None on success
+    outcome = handle_patch_result(item_id, broken_links, error)
+    project_stats[project_id][outcome + ' items'] += 1
+    record_patch_outcome(project_id, item_id, outcome)
+    if fix_journal is not None:
+        fix_journal.done(project_id, item_id, outcome)
+
+
+def resume_project(project_id, broken_link_map, show_progress):
+    # STEP THREE only, for the patches an interrupted run planned but did not finish. every item is fetched
+    # again first, and a field that changed since the interrupted run is left alone
+    project_start_time = time.time()
+    stats = project_stats[project_id]
+    logger.info('Resuming ' + str(len(broken_link_map)) + ' planned patch(es) on project ID:[' +
+                str(project_id) + ']')
+    try:
+        item_ids = list(broken_link_map)
+        items = api_pool.map(get_planned_item, item_ids)
+        resumed_link_map = {}
+        for item_id, item in zip(item_ids, items):
+            if item is None:
+                project_outcomes[project_id][item_id] = 'unresolved'
+                continue
+            if is_already_patched(item, broken_link_map[item_id]):
+                # the patch went through, but the run was interrupted before its outcome was journaled
+                logger.log(ITEM_DETAIL, 'Item ID:[%s] was already updated by the interrupted run', item_id)
+                finish_patch(project_id, item_id, broken_link_map[item_id], None)
+                continue
+            broken_links = build_resumed_fixes(item, project_id, broken_link_map[item_id])
+            if len(broken_links) > 0:
+                resumed_link_map[item_id] = broken_links
+        stats['items with broken links'] += len(resumed_link_map)
+        if stats['stale fields'] > 0:
+            logger.warning(str(stats['stale fields']) + ' field(s) in project ID:[' + str(project_id) +
+                           '] changed since the interrupted run and were skipped, run again to rescan them')
+        patch_project(project_id, resumed_link_map, show_progress)
+    except (APIException, CircuitOpenError, requests.exceptions.RequestException) as e:
+        stats['failed projects'] += 1
+        logger.error('Failed to process project ID:[' + str(project_id) + ']. Exception: ' + str(e))
+    stats['seconds'] += time.time() - project_start_time
+
+
+def apply_project(project_id, planned_fields, show_progress):
+    # STEP THREE only, for the changes a dry run planned. every item is fetched again first, and a field
+    # that changed since the plan was made is left alone
+    project_start_time = time.time()
+    stats = project_stats[project_id]
+    logger.info('Applying the planned changes to ' + str(len(planned_fields)) + ' item(s) in project ID:[' +
+                str(project_id) + ']')
+    try:
+        item_ids = list(planned_fields)
+        items = api_pool.map(get_planned_item, item_ids)
+        broken_link_map = {}
+        for item_id, item in zip(item_ids, items):
+            if item is None:
+                project_outcomes[project_id][item_id] = 'unresolved'
+                continue
+            broken_links = build_planned_fixes(item, project_id, planned_fields[item_id])
+            if len(broken_links) > 0:
+                broken_link_map[item_id] = broken_links
+        stats['items with broken links'] += len(broken_link_map)
+        if stats['stale fields'] > 0:
+            logger.warning(str(stats['stale fields']) + ' field(s) in project ID:[' + str(project_id) +
+                           '] changed since the plan was made and were skipped, run again to plan them')
+
+        if fix_journal is not None:
+            fix_journal.plan(project_id, broken_link_map)
+        patch_project(project_id, broken_link_map, show_progress)
+    except (APIException, CircuitOpenError, requests.exceptions.RequestException) as e:
+        stats['failed projects'] += 1
+        logger.error('Failed to process project ID:[' + str(project_id) + ']. Exception: ' + str(e))
+    stats['seconds'] += time.time() - project_start_time
+
+
+def get_planned_item(item_id):
+    try:
+        return call_api(client.get_item, item_id)
+    except (APIException, requests.exceptions.RequestException) as e:
+        logger.error('Unable to get planned item ID:[' + str(item_id) + ']. Exception: ' + str(e))
+        return None
+
+
+def build_planned_fixes(item, project_id, field_plans):
+    # the data needed to patch the item, from the changes planned for each of its fields
+    item_id = item.get('id')
+    if is_planned_item_locked(item, project_id):
+        return []
+
+    broken_links = []
+    item_fix = ItemFix(item_id, project_id, str(item.get('documentKey')), item.get('lock').get('lockedBy'))
+    for field_plan in field_plans:
+        value = get_unchanged_field_value(item, project_id, field_plan['field'], field_plan['oldValueHash'])
+        if value is None:
+            continue
+        edits = [LinkEdit(change['start'], change['end'], change['new'], tuple(change['oldTarget']),
+                          tuple(change['newTarget'])) for change in field_plan['changes']]
+        broken_links.append(FieldFix(item_fix, field_plan['field'], value, edits, field_plan['linkCount']))
+    return broken_links
+
+
+def build_resumed_fixes(item, project_id, broken_links):
+    # the journaled fixes of the item whose fields are still as they were when the interrupted run scanned them
+    if is_planned_item_locked(item, project_id):
+        return []
+    resumed_links = []
+    for b in broken_links:
+        value = get_unchanged_field_value(item, project_id, b.field_name, hash_field_value(b.old_value))
+        if value is not None:
+            resumed_links.append(b)
+    return resumed_links
+
+
+def is_already_patched(item, broken_links):
+    return all(item.get('fields').get(b.field_name) == b.build_new_value() for b in broken_links)
+
+
+def is_planned_item_locked(item, project_id):
+    # a planned item that has been locked since is logged to the locked items report instead of patched
+    if not item.get('lock').get('locked'):
+        return False
+    logger.log(ITEM_DETAIL, "Item was locked and has a broken link.  Logging to the locked items report...")
+    log_locked_items(str(item.get('documentKey')), user_directory.get_full_name(item.get('lock').get('lockedBy')),
+                     build_item_url(item.get('id'), project_id))
+    project_stats[project_id]['locked items'] += 1
+    project_outcomes[project_id][item.get('id')] = 'locked'
+    return True
+
+
+def get_unchanged_field_value(item, project_id, field_name, old_value_hash):
+    # the field's value, or None if it changed since the fix was planned. the planned edits are offsets into
+    # the value as it was scanned, so they can only be made to that same value
+    value = item.get('fields').get(field_name)
+    if isinstance(value, str) and hash_field_value(value) == old_value_hash:
+        return value
+    logger.warning('Field [' + field_name + '] on item ID:[' + str(item.get('id')) +
+                   '] changed since the fix was planned, skipping it')
+    project_stats[project_id]['stale fields'] += 1
+    project_outcomes[project_id][item.get('id')] = 'unresolved'
+    return None
+
+
+def record_patch_outcome(project_id, item_id, outcome):
+    # a failed patch leaves the item's links unresolved, the next incremental run should look at it again.
+    # an item that also had links we could not resolve stays unresolved even when the rest were fixed
+    if outcome == 'patched' and project_outcomes[project_id].get(item_id) == 'unresolved':
+        return
+    project_outcomes[project_id][item_id] = {'patched': 'fixed', 'locked': 'locked'}.get(outcome, 'unresolved')
+
+
+def format_project_summary(label, stats):
+    return (label + ': ' + str(stats['items']) + ' item(s) scanned, ' + str(stats['items skipped']) +
+            ' skipped as unchanged, ' + str(stats['items with broken links']) +
+            ' with broken links, ' + str(stats['patched items']) + ' patched, ' +
+            str(stats['locked items']) + ' locked, ' + str(stats['failed items']) + ' failed (' +
+            '%.2f' % stats['seconds'] + ' seconds)')
 
 
 def log_locked_items(item_name, locked_by, url):
-    # Check for duplicate rows
-    if item_name not in locked_item_data:
-        locked_item_data[item_name] = [item_name, locked_by, url]
-        logger.info("Item {} is locked and was added to the Excel workbook.".format(item_name))
+    # duplicate rows are dropped by the report
+    if locked_items_report.add(item_name, locked_by, url):
+        logger.log(ITEM_DETAIL, "Item %s is locked and was added to the locked items report.", item_name)
 
 
 # link fixer script, will identify broken links from old projects, and correct the links
 # a link to the past
 if __name__ == '__main__':
+    args = parse_args()
     warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
     # int some logging ish
-    logger = init_logger()
+    logger, log_listener = init_logger()
     start_time = time.time()
-    workbook = start_workbook()
-    sheet = workbook.active
+    api_call_stats = ApiCallStats()
+    # profiles the main thread, which is where the scan runs unless there are scan workers
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     logger.info('Running link fixer script')
 
     config = configparser.ConfigParser()
     config.read('config.ini')
+    logger.setLevel(get_log_verbosity())
+    # rows are added as locked items are found, and whatever was found is still written if the run dies. the
+    # file is only created once there is something to write, or at the end of the run
+    locked_items_report = LockedItemsReport(get_locked_items_report())
+    atexit.register(locked_items_report.close)
     logger.info('Reading in configuration file')
 
     # make sure we have a mode specified to run on
@@ -258,325 +2421,207 @@ if __name__ == '__main__':
         logger.info('running link mode')
     if get_text_mode():
         logger.info('running text mode')
-
+    if args.incremental:
+        logger.info('running incremental mode')
+    if args.resume:
+        logger.info('resuming from the fix journal')
+    if args.dry_run is not None:
+        logger.info('running a dry run, nothing will be patched')
+    if args.apply is not None:
+        logger.info('applying the plan in <' + args.apply + '>')
+    if get_candidate_search() and not args.resume and args.apply is None:
+        logger.warning('candidate search only scans the items the search finds, items whose jama links are only '
+                       'in the link markup may be missed. run a full scan now and then')
+
+    # paces every api request and stops the run if too many of them fail
+    request_scheduler = RequestScheduler(get_max_requests_per_second(), get_max_error_rate())
+    # read only responses kept on disk between runs
+    response_cache = None
+    if get_response_cache_file() is not None:
+        response_cache = ResponseCache(get_response_cache_file(), get_response_cache_size(),
+                                       get_response_cache_ttls())
     client = init_jama_client()
+    # one worker pool for all the concurrent api work, sized by the max concurrency parameter
+    api_pool = ThreadPoolExecutor(max_workers=get_max_concurrency())
     instance_url = get_instance_url(config['CREDENTIALS'])
     logger.info('Successfully connected to instance: <' + instance_url + '>')
 
-    # grab the required script parameters from the config.ini file.
-    project_id = get_project_id()
+    # worker processes for parsing and rewriting the rich text fields, they log to the same log file. each
+    # is a pool of its own so a shard can be parsed and rewritten by the same worker
+    scan_pools = None
+    if get_scan_workers() > 0:
+        worker_log_queue = start_worker_log_listener()
+        scan_pools = [ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=init_scan_worker,
+                                          initargs=(dict(config['PARAMETERS']), instance_url, worker_log_queue))
+                      for i in range(get_scan_workers())]
+        logger.info('scanning with ' + str(get_scan_workers()) + ' worker process(es)')
 
     # extra data needed for processing
     valid_project_ids = set()
+    link_prefilter = build_link_prefilter(instance_url)
+    candidate_search_terms = build_candidate_search_terms(instance_url)
+    extract_links = get_link_extractor()
 
     """
     STEP ZERO - get all the needed meta data to do this work
     """
+    metadata_start_time = time.time()
     spinner_message = 'Retrieving required meta data from instance...'
     spinner = Halo(text=spinner_message, spinner='dots')
     spinner.start()
-    project_list = client.get_projects()
+    project_list = call_api(client.get_projects)
     for project in project_list:
         valid_project_id = project.get('id')
         valid_project_ids.add(valid_project_id)
-    spinner.stop()
 
-    """
-    STEP ONE - get all items from project    
-    """
-    # let's validate the project id here before continuing
-    if project_id not in valid_project_ids:
-        logger.error('Invalid project id provided in the config.ini')
-        sys.exit()
-
-    spinner_message = 'Retrieving all items from project ID:[' + str(project_id) + ']'
-    spinner = Halo(text=spinner_message, spinner='dots')
-    spinner.start()
-    items = client.get_items(project_id)
+    # lock owner names, looked up lazily unless we are asked to load them all now
+    user_directory = UserDirectory(client, instance_url, get_user_cache_file())
+    user_directory.load()
+    if get_seed_user_cache():
+        try:
+            user_directory.seed()
+        except APIException as e:
+            logger.warning('Unable to seed the user cache, users will be looked up as needed. Exception: ' + str(e))
     spinner.stop()
-    logger.info('Retrieving ' + str(len(items)) + ' items from project ID:[' + str(project_id) + ']')
-
-    """
-    STEP TWO - iterate over all the retrieved items and find bad links   
-    """
-    broken_link_map = {}
-    for item in items:
-        item_id = item.get('id')
-        item_document_key = item.get('documentKey')
-        fields = item.get('fields')
-        item_url = instance_url + "/perspective.req#/items/" + str(item_id) + "?projectId=" + str(project_id)
-
-        # Getting lock properties, so we don't need to call the API multiple times for Excel logging
-        item_lock_properties = item.get('lock')
-        item_locked_by = item_lock_properties.get('lockedBy')
-
-        if item_locked_by is None:
-            item_locked_by_fullname = "System"
-        else:
-            locked_by_user = client.get_user(item_locked_by)
-            item_locked_by_firstname = locked_by_user.get("firstName")
-            item_locked_by_lastname = locked_by_user.get("lastName")
-            item_locked_by_fullname = item_locked_by_firstname + " " + item_locked_by_lastname
-
-        for key in fields:
-            original_value = fields[key]
-            value = fields[key]
-            soup = BeautifulSoup(str(value), 'html.parser')
-            hyperlinks = soup.find_all('a')
-            bad_link_found = False
-            bad_link_count = 0
-
-            if len(hyperlinks) > 0:
-                logger.info('\nProcessing ' + str(len(hyperlinks)) + ' hyperlinks on item ID:[' + str(
-                    item_id) + '] on field name:[' + str(key) + ']')
-
-            counter = 0
-
-            # remove any duplicate entries in this list.
-            hyperlinks = list(dict.fromkeys(hyperlinks))
-
-            # iterate over all the hyperlinks
-            for hyperlink in hyperlinks:
-                counter += 1
-                href = hyperlink.get('href')
-                parsed_link = urlparse.urlparse(href)
-                hyperlink_string = str(hyperlink)
-
-                # we only want to process jama links. let's skip over all the other links
-                if parsed_link.hostname is None or parsed_link.hostname not in instance_url:
-                    continue
-
-                url_parameters = urlparse.parse_qs(parsed_link.query)
-                linked_project_id = None
-                linked_item_id = None
-                # do we have paramaters from the url? new url formatting from jama that we need to cover
-                if not url_parameters:
-                    try:
-                        # e.g fragment... /items/10140?projectId=77'
-                        link_fragment = parsed_link.fragment
-                        linked_project_id = link_fragment.split('projectId=')[1]
-                        linked_item_id = link_fragment.split('?')[0].split('items/')[1]
-                    except Exception as e:
-                        logger.error('failed to get url parameters, error:', e)
-                        logger.error('unable to identify project and item ids from link <' +
-                                     href + '> skipping current link...')
-                        continue
-                # otherwise assume that this url will have proper params we can access
-                else:
-                    try:
-                        linked_project_id = url_parameters['projectId'][0]
-                        linked_item_id = url_parameters['docId'][0]
-                    except Exception as e:
-                        logger.error('failed to get url parameters, error:', e)
-                        logger.error('unable to identify project and item ids from link <' +
-                                     href + '> skipping current link...')
-                        continue
-
-                logger.info('--- link ' + str(counter) + ' --- Processing link with item ID:[' + str(
-                    linked_item_id) + '] and project ID:[' + str(linked_project_id) + ']...')
-
-                try:
-                    original_item = client.get_item(item_id)
-                except APIException as e:
-                    logger.error('Unable to get original data on item ID:[' + str(item_id) + ']. Exception: ' + str(e))
-
-                # let's see if there is a synced item for this link
-                corrected_item_id = get_synced_item(linked_item_id, project_id)
-
-                if int(linked_project_id) == int(project_id) and original_item is not None:
-                    # we have a valid link here, but do we have a mismatched name?
-
-                    try:
-                        target_item = client.get_item(linked_item_id)
-                        corrected_item_id = target_item['id']
-                    except APIException as e:
-                        logger.error(
-                            'Unable to get target item data on item ID:[' + str(
-                                linked_item_id) + ']. Exception: ' + str(e))
-
-                    # are we running text mode? if so were updating the name
-                    if get_text_mode():
-                        sourceName = hyperlink_string[hyperlink_string.index('>') + 1:hyperlink_string.index('</a>')]
-                        targetName = get_item_field(target_item['id'], get_display_attribute())
-                        targetName = targetName.replace('&', '&amp;') #Encode ampersand as $amp; to match sourceName
-
-                        if sourceName == targetName:
-                            logger.info("valid link detected. skipping.")
-                            continue
-
-                    # otherwise we already have a valid link, quit
-                    else:
-                        logger.info("valid link detected. skipping.")
-                        continue
-                elif original_item is None or original_item is {}:
-                    logger.error('Unable to find original item ID:[' + item_id + ']')
-                    continue
-                elif corrected_item_id is None:
-                    logger.error('Unable to find synced item, skipping link')
-                    continue
-
-                # we must have a single item id before continuing here.
-                # also does this project id param not match the current project?
-                # if so then this is a bad link
-                # there could potentially be more than one bad link per field value. so
-                # let's keep track of that.
-                if get_link_mode():
-                    logger.info(
-                        'Identified incorrect link, will update... item ID:[' + str(corrected_item_id) + ']')
-
-                bad_link_found = True
-                bad_link_count += 1
-
-                # is text mode enabled? if so then update the link name here
-                corrected_item_name = None
-                if get_text_mode():
-                    corrected_item_name = get_item_field(corrected_item_id, get_display_attribute())
-                    # are we running only text mode here?
-                    if not get_link_mode():
-                        # dont do any redundant updates
-                        sourceName = hyperlink_string[hyperlink_string.index('>') + 1:hyperlink_string.index('</a>')]
-                        # skip this link if it's already matching here (no work to be done)
-                        if sourceName == corrected_item_name:
-                            bad_link_found = False
-                            continue
-
-                # otherwise text mode is disabled. so use the existing name here.
-                else:
-                    try:
-                        corrected_item_name = hyperlink_string[
-                                              hyperlink_string.index('>') + 1:hyperlink_string.index('</a>')]
-                    except:
-                        logger.error('failed to resolve link name, this link will not update')
-                        continue
-
-                    # let's do the work to change the links name to match the new correct item name
-
-                corrected_hyperlink_string = hyperlink_string[
-                                             0:hyperlink_string.index('>') + 1] + corrected_item_name + '</a>'
-
-                #  is link mode enabled?
-                if get_link_mode():
-                    corrected_hyperlink_string = corrected_hyperlink_string.replace(
-                        'projectId=' + str(linked_project_id),
-                        'projectId=' + str(project_id))
-                    corrected_hyperlink_string = corrected_hyperlink_string.replace('docId=' + str(linked_item_id),
-                                                                                    'docId=' + str(
-                                                                                        corrected_item_id))
-
-                # if we have made it this far then let's go ahead and replace the hyperlink
-                if hyperlink_string in value:
-                    value = value.replace(hyperlink_string, corrected_hyperlink_string)
-                # otherwise we have a character encoding problem here.
-                else:
-                    start_link = hyperlink_string[0:hyperlink_string.index('>') + 1]
-                    end_link = '</a>'
-
-                    start_index = value.index(start_link) + len(start_link)
-                    end_index = 0
-
-                    # iterate over the string until we encounter a "<" to get the end_index
-                    for i in range(start_index, len(value)):
-                        if value[i] == '<':
-                            end_index = i
-                            break
-
-                    encoded_name = value[start_index:end_index]
-                    hyperlink_string = start_link + encoded_name + end_link
-                    value = value.replace(hyperlink_string, corrected_hyperlink_string)
-
-                # we have a bad link for this item?
-                if bad_link_found:
-                    # Before we replace the hyperlink, let's check if it's locked and log it to Excel if so
-                    if item_lock_properties['locked']:
-                        logger.info("Item was locked and has a broken link.  Logging to Excel File...\n")
-                        log_locked_items(str(item_document_key), str(item_locked_by_fullname), str(item_url))
-
-                    # let's build out an object of all the data we care about for patching and logging
-                    else:
-                        broken_link_data = {
-                            'fieldName': key,
-                            'newValue': value,
-                            'oldValue': original_value,
-                            'counter': str(bad_link_count),
-                            'itemId': str(item_id),
-                            'itemUrl': str(item_url),
-                            'itemLockedBy': str(item_locked_by_fullname),
-                            'documentKey': str(item_document_key)
-                        }
-                        broken_list = broken_link_map.get(item_id)
-                        if broken_list is None:
-                            broken_list = [broken_link_data]
-                        else:
-                            broken_list.append(broken_link_data)
-                        broken_link_map[item_id] = broken_list
-
-    """
-    STEP THREE - fix and log all broken hyperlinks
-    """
-    # use a progress bar here. this can be a very long-running process
-    if len(broken_link_map) > 0:
-        with ChargingBar('Updating links ', max=len(broken_link_map),
-                         suffix='%(percent).1f%% - %(eta)ds') as bar:
-            # iterate over the map, and do work
-            for item_id, broken_links in broken_link_map.items():
-
-                patch_list = []
-                changed_list = []
-
-                logger.info('Updating link(s) on item ID: [' + str(item_id) + ']')
-
-                for b in broken_links:
-                    # log out the old and new rich text values.
-                    logger_old_value = b.get('oldValue').replace('\n', '\n\t')
-                    logger_new_value = b.get('newValue').replace('\n', '\n\t')
-                    logger.info(
-                        'Field with name [' + b.get('fieldName') + '] contains ' + b.get('counter') +
-                        ' link(s) to be updated')
-
-                    payload = {
-                        'op': 'replace',
-                        'path': '/fields/' + b.get('fieldName'),
-                        'value': b.get('newValue')
-                    }
-                    patch_list.append(payload)
-
-                # let's try and patch this data
-                try:
-                    client.patch_item(item_id, patch_list)
-                    name = b.get('itemId') if b.get('itemId') is not None else "Unknown Item ID"
-                    logger.info('Successfully patched item [' + str(name) + ']')
-                except APIException as error:
-                    if "locked" in str(error):
-                        try:
-                            log_locked_items(str(b.get('documentKey')), str(b.get('itemLockedBy')),
-                                             b.get('itemUrl'))
-                            logger.info("Log locked items method successful for Item ID: " + str(b.get('itemId')))
-                        except Exception as e:
-                            logger.error('Failed to log locked items for [' + str(b.get('itemId')) + ']')
-                            logger.error('Error: ' + str(e))
-                    else:
-                        # Failed to patch
-                        logger.error('Failed to patch item [' + str(b.get('itemId')) + ']')
-                        logger.error('API exception response: ' + str(error))
-
-                bar.next()
-            bar.finish()
-            logger.info('updated ' + str(len(broken_link_map)) + ' link(s)')
+    metadata_seconds = time.time() - metadata_start_time
+
+    # the item cache and the synced item resolver are shared by every project in the run
+    item_cache = ItemCache(client, get_display_attribute(), get_item_cache_size())
+    synced_item_resolver = SyncedItemResolver(api_pool)
+    scan_checkpoint = None
+    fix_journal = None
+    fix_plan = None
+
+    if args.apply is not None:
+        # make the changes a dry run planned, there is no need to scan again
+        if not os.path.exists(args.apply):
+            logger.error('unable to apply, plan file <' + args.apply + '> not found')
+            sys.exit()
+        planned_changes = read_fix_plan(args.apply)
+        if get_journal_file() is not None:
+            fix_journal = FixJournal(get_journal_file())
+        project_ids = list(planned_changes)
+        for project_id in project_ids:
+            project_stats[project_id] = collections.Counter()
+            project_outcomes[project_id] = {}
+            apply_project(project_id, planned_changes[project_id], True)
+    elif args.resume:
+        # pick up the patches an interrupted run planned but did not finish, there is no need to scan again
+        if get_journal_file() is None or not os.path.exists(get_journal_file()):
+            logger.error("unable to resume, no fix journal found. check the 'journal file' in the config ini")
+            sys.exit()
+        pending_patches = read_fix_journal(get_journal_file())
+        fix_journal = FixJournal(get_journal_file(), resume=True)
+        project_ids = list(pending_patches)
+        logger.info('Resuming ' + str(sum(len(patches) for patches in pending_patches.values())) +
+                    ' planned patch(es) across ' + str(len(project_ids)) + ' project(s)')
+        for project_id in project_ids:
+            project_stats[project_id] = collections.Counter()
+            project_outcomes[project_id] = {}
+            resume_project(project_id, pending_patches[project_id], True)
     else:
-        logger.info('There are zero links to be corrected, exiting...')
-
-    for item in locked_item_data:
-        sheet.append(locked_item_data[item])
-
-    column_letter = 'C'
-    column_index = openpyxl.utils.cell.column_index_from_string(column_letter)
-    hyperlink_font = Font(color="0000FF", underline="single")
-    for row in sheet.iter_rows(min_row=2, min_col=column_index, max_col=column_index):
-        cell = row[0]
-        cell.hyperlink = cell.value
-        cell.font = hyperlink_font
-    workbook.save("locked_items.xlsx")
+        # grab the projects to run against, "all" runs against every project on the instance
+        project_ids = get_project_ids(valid_project_ids)
+        logger.info('Running against ' + str(len(project_ids)) + ' project(s)')
+        for project_id in project_ids:
+            project_stats[project_id] = collections.Counter()
+            project_outcomes[project_id] = {}
+
+        # how every item looked when it was last scanned, for incremental runs
+        if get_checkpoint_file() is not None:
+            scan_checkpoint = ScanCheckpoint(get_checkpoint_file(), instance_url)
+        elif args.incremental:
+            logger.error("incremental mode needs a 'checkpoint file' in the config ini")
+            sys.exit()
+
+        # every patch is written to the journal before it is sent, so this run can be resumed if it is interrupted.
+        # a dry run writes its plan instead, and leaves the journal of the last real run alone
+        if args.dry_run is not None:
+            fix_plan = FixPlanWriter(args.dry_run)
+        elif get_journal_file() is not None:
+            fix_journal = FixJournal(get_journal_file())
+
+        if len(project_ids) == 1:
+            run_project(project_ids[0], True)
+        else:
+            # spinners and progress bars from several projects at once would overwrite each other
+            show_progress = get_max_concurrent_projects() == 1
+            with ThreadPoolExecutor(max_workers=get_max_concurrent_projects()) as project_pool:
+                list(project_pool.map(lambda batch_project_id: run_project(batch_project_id, show_progress),
+                                      project_ids))
+
+    # per project summary, then the totals for the whole run
+    run_stats = collections.Counter()
+    for project_id in project_ids:
+        stats = project_stats[project_id]
+        run_stats.update(stats)
+        if len(project_ids) > 1:
+            logger.info(format_project_summary('project ID:[' + str(project_id) + ']', stats))
+    logger.info(format_project_summary('run total', run_stats))
+
+    locked_items_report.close(create=True)
+    logger.info('locked items report: ' + str(len(locked_items_report.item_names)) + ' item(s) written to <' +
+                locked_items_report.path + '>')
+
+    api_pool.shutdown()
+    if scan_pools is not None:
+        for scan_pool in scan_pools:
+            scan_pool.shutdown()
+    user_directory.save()
+    if scan_checkpoint is not None:
+        scan_checkpoint.close()
+    if response_cache is not None:
+        response_cache.close()
+    if fix_journal is not None:
+        fix_journal.close()
+    if fix_plan is not None:
+        fix_plan.close()
+    logger.info('items downloaded: ' + str(run_stats['items downloaded']) + ' of ' +
+                str(run_stats['project items']) + ' item(s) in the project(s)')
+    logger.info('pre-filter: ' + str(run_stats['fields skipped']) + ' field(s) skipped, ' +
+                str(run_stats['fields parsed']) + ' field(s) parsed')
+    logger.info('item cache: ' + str(item_cache.hits) + ' hit(s), ' + str(item_cache.misses) + ' miss(es)')
+    if response_cache is not None:
+        response_cache_stats = response_cache.to_dict()
+        logger.info('response cache: ' + str(response_cache_stats['hits']) + ' hit(s), ' +
+                    str(response_cache_stats['revalidated']) + ' revalidated, ' +
+                    str(response_cache_stats['misses']) + ' miss(es), ' + str(response_cache_stats['evictions']) +
+                    ' eviction(s)' + ('' if response_cache_stats['hitRate'] is None else
+                                      ', ' + '%.1f' % (response_cache_stats['hitRate'] * 100) + '% hit rate'))
+    logger.info('html parsed: ' + str(run_stats['html bytes']) + ' byte(s) in ' +
+                '%.2f' % run_stats['parse seconds'] + ' seconds')
+    phase_seconds = get_phase_seconds(metadata_seconds, run_stats)
+    logger.info('phase times: ' + ', '.join(phase + ' ' + '%.2f' % seconds + 's'
+                                            for phase, seconds in phase_seconds.items()))
+    for method_name, method_stats in api_call_stats.to_dict().items():
+        logger.info('api ' + method_name + ': ' + str(method_stats['calls']) + ' call(s), ' +
+                    str(method_stats['errors']) + ' error(s), ' + str(method_stats['averageMs']) + ' ms average, ' +
+                    str(method_stats['maxMs']) + ' ms max')
 
     # were done here
     elapsed_time = '%.2f' % (time.time() - start_time)
     logger.info('total execution time: ' + elapsed_time + ' seconds')
+    log_file_base = os.path.splitext(get_log_file())[0]
+    write_run_summary(log_file_base + '.summary.json', time.time() - start_time, phase_seconds, run_stats)
+    logger.info('run summary written to <' + log_file_base + '.summary.json>')
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(log_file_base + '.prof')
+        with open(log_file_base + '.profile.txt', 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+        logger.info('profile written to <' + log_file_base + '.prof> and <' + log_file_base + '.profile.txt>')
+    if request_scheduler.throttled_responses > 0 or request_scheduler.retried_requests > 0:
+        logger.info('requests: ' + str(request_scheduler.throttled_responses) + ' throttled response(s), ' +
+                    str(request_scheduler.retried_requests) + ' retried request(s)' +
+                    ('' if request_scheduler.rate is None else
+                     ', finished at ' + '%.1f' % request_scheduler.rate + ' request(s) per second'))
+    if request_scheduler.open_reason is not None:
+        logger.error('The run was stopped early because ' + request_scheduler.open_reason + '. Check the instance '
+                     'is available, then run with --resume to finish the planned fixes, or run again to rescan')
+        sys.exit(1)
+    # so a scheduled run where projects failed does not look like it succeeded
+    if run_stats['failed projects'] > 0:
+        logger.error(str(run_stats['failed projects']) + ' of ' + str(len(project_ids)) +
+                     ' project(s) failed, see the errors above')
+        sys.exit(1)
@@ -0,0 +1,158 @@
+import configparser
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import link_fixer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'jama_fields')
+FIXTURES = sorted(name for name in os.listdir(FIXTURES_DIR) if name.endswith('.html'))
+EXTRACTORS = ['bs4', 'lxml', 'tokenizer']
+# (link mode, text mode)
+MODES = [(True, True), (True, False), (False, True)]
+
+INSTANCE_URL = 'https://example.jamacloud.com'
+OLD_PROJECT_ID = 1
+PROJECT_ID = 2
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def configure(extractor, link_mode=True, text_mode=True):
+    # the globals the __main__ block sets up before a scan
+    link_fixer.config = configparser.ConfigParser()
+    link_fixer.config.read_dict({'PARAMETERS': {'link mode': str(link_mode), 'text mode': str(text_mode),
+                                                'display attribute': 'name'}})
+    link_fixer.logger = logging.getLogger('link_fixer_tests')
+    link_fixer.instance_url = INSTANCE_URL
+    link_fixer.link_prefilter = link_fixer.build_link_prefilter(INSTANCE_URL)
+    link_fixer.extract_links = link_fixer.link_extractors[extractor]
+
+
+def build_link_target(linked_project_id, linked_item_id):
+    # the old project's items were copied to the new project with 1000 added to their ids
+    corrected_item_id = int(linked_item_id)
+    if int(linked_project_id) == OLD_PROJECT_ID:
+        corrected_item_id += 1000
+    return link_fixer.LinkTarget(corrected_item_id, 'Item & ' + str(corrected_item_id))
+
+
+def rewrite_field(value):
+    # the field value after its broken links are fixed, as it would be patched
+    item = {'id': 5001, 'documentKey': 'NEW-5001', 'fields': {'description': value}, 'lock': {'locked': False}}
+    field_links = link_fixer.parse_item_links(item, PROJECT_ID)
+    link_targets = {pair: build_link_target(*pair) for pair in link_fixer.collect_link_targets([field_links])}
+    broken_links, item_locked_with_broken_links = link_fixer.scan_item(item, PROJECT_ID, link_targets, field_links)
+    assert not item_locked_with_broken_links
+    if len(broken_links) == 0:
+        return value
+    return broken_links[0].build_new_value()
+
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+def test_extractors_find_the_same_links(fixture):
+    value = read_fixture(fixture)
+    found_links = {}
+    for extractor in EXTRACTORS:
+        configure(extractor)
+        field_links = link_fixer.parse_item_links({'id': 5001, 'fields': {'description': value}}, PROJECT_ID)
+        anchor_count, hyperlinks = field_links['description']
+        found_links[extractor] = (anchor_count, [hyperlink.href for hyperlink in hyperlinks])
+    assert found_links['bs4'][1] != []
+    assert found_links['lxml'] == found_links['bs4']
+    assert found_links['tokenizer'] == found_links['bs4']
+
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+@pytest.mark.parametrize('link_mode, text_mode', MODES)
+def test_extractors_rewrite_fields_identically(fixture, link_mode, text_mode):
+    value = read_fixture(fixture)
+    rewritten = {}
+    for extractor in EXTRACTORS:
+        configure(extractor, link_mode, text_mode)
+        rewritten[extractor] = rewrite_field(value)
+    assert rewritten['bs4'] != value
+    assert rewritten['lxml'] == rewritten['bs4']
+    assert rewritten['tokenizer'] == rewritten['bs4']
+
+
+@pytest.mark.parametrize('extractor', EXTRACTORS)
+def test_rewrite_only_touches_broken_links(extractor):
+    configure(extractor)
+    value = read_fixture('docid_links.html')
+    rewritten = rewrite_field(value)
+    assert rewritten.count('<a href="https://example.jamacloud.com/perspective.req?docId=2007&amp;projectId=2" '
+                           'target="_blank">Item & 2007</a>') == 2
+    assert '<a href="https://example.jamacloud.com/perspective.req?docId=2012&amp;projectId=2" ' \
+           'target="_blank">Item & 2012</a>' in rewritten
+    assert 'docId=1007' not in rewritten and 'projectId=1"' not in rewritten
+    # everything outside the broken links is left as it was
+    assert rewritten.startswith('<p>The braking system shall meet the requirements in ')
+    assert '<a href="https://www.example.com/standards/iso-26262" target="_blank">ISO 26262</a>' in rewritten
+
+
+@pytest.mark.parametrize('extractor', EXTRACTORS)
+def test_rewrite_fragment_links(extractor):
+    # the item id is in the fragment's path, not in a docId parameter
+    configure(extractor)
+    rewritten = rewrite_field(read_fixture('fragment_links.html'))
+    assert '<a href="https://example.jamacloud.com/perspective.req#/items/2008?projectId=2">Item & 2008</a>' \
+           in rewritten
+    assert '<a href="https://example.jamacloud.com/perspective.req#/items/2009?projectId=2">Item & 2009</a>' \
+           in rewritten
+    assert 'items/1008' not in rewritten and 'items/1009' not in rewritten
+    # the link to the project's own item only gets its text rewritten
+    assert '<a href="https://example.jamacloud.com/perspective.req#/items/2010?projectId=2">Item & 2010</a>' \
+           in rewritten
+
+
+@pytest.mark.parametrize('extractor', EXTRACTORS)
+@pytest.mark.parametrize('link_mode, text_mode', MODES)
+def test_upper_case_closing_tag(extractor, link_mode, text_mode):
+    configure(extractor, link_mode, text_mode)
+    value = ('<p><A HREF="https://example.jamacloud.com/perspective.req?docId=2003&amp;projectId=2">Old</A> '
+             '<a href="https://example.jamacloud.com/perspective.req?docId=1004&amp;projectId=1">Other</a ></p>')
+    rewritten = rewrite_field(value)
+    if text_mode:
+        assert '>Item & 2003</a>' in rewritten
+        assert '>Item & 2004</a>' in rewritten
+    else:
+        assert '<A HREF="https://example.jamacloud.com/perspective.req?docId=2003&amp;projectId=2">Old</A>' \
+               in rewritten
+        assert '>Other</a>' in rewritten
+    assert ('docId=2004&amp;projectId=2' in rewritten) == link_mode
+
+
+@pytest.mark.parametrize('extractor', EXTRACTORS)
+def test_matching_link_text_is_left_alone(extractor):
+    # the link text is markup, the display value is plain text
+    configure(extractor, link_mode=False, text_mode=True)
+    value = '<p><a href="https://example.jamacloud.com/perspective.req?docId=2003&amp;projectId=2">Item &amp; 2003</a></p>'
+    assert rewrite_field(value) == value
+
+
+def test_find_anchor_spans_character_encoding():
+    # bs4 re-encodes the link text, so its anchor html is not in the field and has to be matched on the text
+    configure('bs4')
+    value = read_fixture('character_encoding.html')
+    for hyperlink in link_fixer.extract_links_bs4(value):
+        if 'docId=' not in hyperlink.href:
+            continue
+        spans = link_fixer.find_anchor_spans(value, hyperlink.html)
+        assert len(spans) == 1
+        start, end = spans[0]
+        assert value[start:end].startswith('<a href="' + hyperlink.href.replace('&', '&amp;') + '">')
+        assert value[start:end].endswith('</a>')
+
+
+def test_find_anchor_spans_upper_case_closing_tag():
+    value = '<p><a href="https://example.jamacloud.com/x">Caf&eacute;</A></p>'
+    spans = link_fixer.find_anchor_spans(value, '<a href="https://example.jamacloud.com/x">Café</a>')
+    assert spans == [(3, len(value) - 4)]